@@ -0,0 +1,234 @@
+from datetime import timedelta
+
+import numpy as np
+
+from distribution import BernoulliDistribution, NormalDurationDistribution, NormalTimeDistribution
+from settings import MINIMUM_TRAVEL_MARGIN
+from util import toEpoch
+import ride
+
+
+# classes of the distributions of an activity (start, duration, chance, bridge chance) that can be sampled in batch
+BATCH_CLASSES = (NormalTimeDistribution, NormalDurationDistribution, BernoulliDistribution, BernoulliDistribution)
+
+# streams of DayStreams, one per kind of value of a day
+OCCURRENCES, STARTS, DURATIONS, BRIDGES, LOCATIONS, NOTIFICATIONS = range(6)
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)      # odd constant of splitmix64, spreads consecutive keys over all bits
+MICROSECOND = timedelta(microseconds=1)
+
+
+def distributionsOf(activity):
+    return activity.startDistribution, activity.durationDistribution, activity.chanceDistribution, activity.bridgeChanceDistribution
+
+
+def isBatchable(activity):
+    """ Whether the distributions of an activity are exactly of BATCH_CLASSES, subclasses might sample differently. """
+    return all(type(distribution) is cls for distribution, cls in zip(distributionsOf(activity), BATCH_CLASSES))
+
+
+def mix(x):
+    """ Finalizer of splitmix64: a well spread uint64 hash of every value of the uint64 array x. """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class DayStreams(object):
+    """
+    Random numbers for rows of (seed, day), with the random and standard_normal of a numpy random Generator so the
+    distributions can sample from it (cfr. Distribution.sampleTable). Each value is a hash of the seed, the day, the stream
+    it is drawn for and its column, instead of the next value of a sequence: the values of a row are the same whichever
+    other rows are generated with it, so a day of a person can be generated again on its own (cfr. Person.fingerprint).
+    """
+    def __init__(self, seeds, days):
+        """
+        :param seeds: uint64 array with the seed of every row (cfr. Person.seed)
+        :param days: datetime64[D] array with the day of every row
+        """
+        self.keys = mix(mix(seeds) ^ (days.astype(np.int64).astype(np.uint64) * GOLDEN))
+        self.stream = None
+
+    def select(self, stream):
+        """ Draw the next values from stream (cfr. OCCURRENCES, ...), streams don't depend on how much others drew. """
+        self.stream = stream << 8
+        return self
+
+    def bits(self, shape):
+        """ uint64 array of shape (rows, columns), the columns counted within the selected stream. """
+        self.stream += 1
+        counters = np.arange(shape[1], dtype=np.uint64) + np.uint64(self.stream << 32)
+        return mix(self.keys[:, None] + counters[None, :] * GOLDEN)
+
+    def random(self, shape):
+        """ Uniform in [0, 1), with the 53 bits of precision of a float. """
+        return (self.bits(shape) >> np.uint64(11)).astype(float) * 2.0 ** -53
+
+    def standard_normal(self, shape):
+        """ Box-Muller transform of two uniforms, the first one in (0, 1] to take the log of. """
+        u1, u2 = 1.0 - self.random(shape), self.random(shape)
+        return np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)
+
+
+def personTables(people):
+    """
+    The activities of people as arrays, padded to the most activities (and locations per activity) of any of them:
+    the parameters of every distribution (cfr. distributionsOf, Distribution.table), which activities exist, and
+    the locations of each activity as index into the travel times between the locations of the person (in microseconds)
+    and their coordinates.
+    """
+    amountActivities = max((len(person.activities) for person in people), default=0)
+    amountLocations = max(len(person.distanceMatrix.travelTimes) for person in people)
+    amountChoices = max((len(activity.locations) for person in people for activity in person.activities), default=1)
+
+    exists = np.zeros((len(people), amountActivities), dtype=bool)
+    choices = np.ones((len(people), amountActivities), dtype=np.int64)             # amount of locations of every activity
+    locations = np.zeros((len(people), amountActivities, amountChoices), dtype=np.int64)
+    homes = np.zeros(len(people), dtype=np.int64)
+    travelTimes = np.zeros((len(people), amountLocations, amountLocations), dtype=np.int64)
+    coordinates = np.zeros((len(people), amountLocations, 2))
+    for i, person in enumerate(people):
+        matrix = person.distanceMatrix
+        n = len(matrix.travelTimes)
+        travelTimes[i, :n, :n] = [[time // MICROSECOND for time in row] for row in matrix.travelTimes]
+        coordinates[i, :n] = matrix.key[0]
+        homes[i] = matrix.index[tuple(person.home)]
+        for a, activity in enumerate(person.activities):
+            exists[i, a] = True
+            choices[i, a] = len(activity.locations)
+            locations[i, a, :len(activity.locations)] = [matrix.index[tuple(location)] for location in activity.locations]
+
+    tables = list()
+    for role, cls in enumerate(BATCH_CLASSES):
+        rows = [[distributionsOf(activity)[role] for activity in person.activities] for person in people]
+        filler = next((distribution for row in rows for distribution in row), None)
+        padded = [distribution for row in rows for distribution in row + [filler] * (amountActivities - len(row))]
+        tables.append({field: values.reshape(len(people), amountActivities) for field, values in cls.table(padded).items()})
+    return tables, exists, choices, locations, homes, travelTimes, coordinates
+
+
+def generateDays(days):
+    """
+    Generate the rides of many days of many people at once, like PersonRides.generateRecords does for one day.
+    Occurrences, start times, durations, bridges, locations and notification times of all days x activities are sampled
+    as arrays (cfr. Distribution.sampleTable) from the streams of the days (cfr. DayStreams), and the rides are made from
+    them as arrays too (cfr. Person.ridesForVisits). Days of people that can't be generated in batch (cfr.
+    Person.batchable) are generated by generateRecords.
+    :param days: list of (PersonRides, day, generatedAt)
+    :return: list with the records (cfr. RideRecord) of the rides of every day, in the order of days
+    """
+    generated = [None] * len(days)
+    batch = list()
+    for i, (personRides, day, generatedAt) in enumerate(days):
+        if personRides.person.batchable:
+            batch.append(i)
+        else:
+            generated[i] = personRides.generateRecords(day, generatedAt)
+    if not batch:
+        return generated
+
+    people = list({id(days[i][0].person): days[i][0].person for i in batch}.values())
+    personIndex = {id(person): p for p, person in enumerate(people)}
+    rows = np.array([personIndex[id(days[i][0].person)] for i in batch])
+    tables, exists, choices, locations, homes, travelTimes, coordinates = personTables(people)
+    amountActivities = exists.shape[1]
+    shape = (len(batch), amountActivities)
+
+    seeds = np.array([person.seed for person in people], dtype=np.uint64)[rows]
+    dates = np.array([days[i][1] for i in batch], dtype="datetime64[D]")
+    # records keep whole seconds, so the rides are generated from a time that is stored exactly
+    generatedAt = [days[i][2].replace(microsecond=0) for i in batch]
+    streams = DayStreams(seeds, dates)
+
+    def table(role):
+        return {field: values[rows] for field, values in tables[role].items()}
+
+    occurs = BernoulliDistribution.sampleTable(table(2), shape, streams.select(OCCURRENCES)) & exists[rows]
+    starts = NormalTimeDistribution.sampleTable(table(0), dates[:, None], shape, streams.select(STARTS)).astype(np.int64)
+    durations = NormalDurationDistribution.sampleTable(table(1), shape, streams.select(DURATIONS)).astype(np.int64)
+    returns = ~BernoulliDistribution.sampleTable(table(3), shape, streams.select(BRIDGES))
+    choice = np.floor(streams.select(LOCATIONS).random(shape) * choices[rows]).astype(np.int64)
+    destinations = np.take_along_axis(locations[rows], choice[:, :, None], axis=2)[:, :, 0]
+
+    # Person.ridesForVisits for all days at once: every activity can add the pending ride back home and the ride to it
+    home = homes[rows]
+    travel = travelTimes[rows]
+    everyRow = np.arange(len(batch))
+    origin = home.copy()
+    returnPending = np.zeros(len(batch), dtype=bool)
+    returnOrigin = home.copy()
+    returnArrival = np.zeros(len(batch), dtype=np.int64)
+    valid, origins, destinationsOf, arrivals = list(), list(), list(), list()
+    for a in range(amountActivities):
+        occurring = occurs[:, a]
+        arrive = starts[:, a]
+        # the ride back home is only made if the person can leave home again in time, else they leave from where they are
+        returnMade = occurring & returnPending & (arrive - travel[everyRow, home, destinations[:, a]] >= returnArrival)
+        valid.append(returnMade)
+        origins.append(returnOrigin)
+        destinationsOf.append(home)
+        arrivals.append(returnArrival)
+        origin = np.where(returnMade, home, origin)
+        returnPending = returnPending & ~returnMade
+
+        valid.append(occurring)
+        origins.append(origin)
+        destinationsOf.append(destinations[:, a])
+        arrivals.append(arrive)
+        origin = np.where(occurring, destinations[:, a], origin)
+
+        returning = occurring & returns[:, a]
+        returnPending = returnPending | returning
+        returnOrigin = np.where(returning, destinations[:, a], returnOrigin)
+        returnArrival = np.where(returning, arrive + durations[:, a], returnArrival)
+    valid.append(returnPending)
+    origins.append(returnOrigin)
+    destinationsOf.append(home)
+    arrivals.append(returnArrival)
+
+    valid, origins, destinationsOf, arrivals = (np.stack(values, axis=1) for values in (valid, origins, destinationsOf, arrivals))
+    # like Person.addNotificationTime: uniform between generatedAt and 5 minutes before the last possible time
+    minimum = np.array([toEpoch(time) for time in generatedAt], dtype=np.int64) * 1000000
+    lastPossible = arrivals - np.round(travel[everyRow[:, None], origins, destinationsOf] * MINIMUM_TRAVEL_MARGIN).astype(np.int64)
+    latest = lastPossible - 5 * 60 * 1000000
+    uniforms = streams.select(NOTIFICATIONS).random(valid.shape)
+    notifications = minimum[:, None] + np.floor((latest - minimum[:, None]) * uniforms).astype(np.int64)
+
+    # rides of a row are numbered in order of their slot, like the uids of PersonRides.addDay
+    index = np.cumsum(valid, axis=1) - 1
+    row, slot = np.nonzero(valid)
+    owner = rows[row]
+    rideOrigins, rideDestinations = origins[row, slot], destinationsOf[row, slot]
+    # lists are much faster than arrays to take single values from
+    columns = (row, index[row, slot], coordinates[owner, rideOrigins, 0], coordinates[owner, rideOrigins, 1],
+               coordinates[owner, rideDestinations, 0], coordinates[owner, rideDestinations, 1], arrivals[row, slot] // 1000000,
+               notifications[row, slot] // 1000000, lastPossible[row, slot] // 1000000)
+    columns = [column.tolist() for column in columns]
+
+    usernames = [days[i][0].person.username for i in batch]
+    passengers = [days[i][0].person.passengers for i in batch]
+    prefixes = [f"{usernames[r]}:{days[i][1].isoformat()}:" for r, i in enumerate(batch)]
+    generatedEpochs = [toEpoch(time) for time in generatedAt]
+    for i in batch:
+        generated[i] = list()
+    for r, number, originLat, originLon, destinationLat, destinationLon, arriveAt, notifyAt, lastNotifyAt in zip(*columns):
+        generated[batch[r]].append(ride.RideRecord(usernames[r], originLat, originLon, destinationLat, destinationLon, arriveAt, notifyAt,
+                                                   lastNotifyAt, passengers[r], f"{prefixes[r]}{number}", generatedEpochs[r]))
+    return generated
+
+
+def generateAll(peopleRides, endDay, minStartTime):
+    """
+    Generate the rides of many people until endDay at once, like PersonRides.generateUntil does for one person.
+    The rides are the same as those of generateUntil (cfr. generateDays), only generating them is faster.
+    :param peopleRides: list of PersonRides
+    :param endDay: generate until this day (exclusive)
+    :param minStartTime: current time, no rides are notified before
+    :return: list of (PersonRides, records of the newly generated rides)
+    """
+    days = [(personRides, day, minStartTime) for personRides in peopleRides for day in personRides.daysUntil(endDay, minStartTime)]
+    generated = {id(personRides): (personRides, list()) for personRides in peopleRides}
+    for (personRides, day, _), records in zip(days, generateDays(days)):
+        generated[id(personRides)][1].extend(records)
+        personRides.lastGeneratedDay = day
+    return list(generated.values())
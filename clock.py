@@ -0,0 +1,71 @@
+import time
+import threading
+from datetime import datetime, timedelta
+
+
+class Clock(object):
+    """
+    Source of time for the simulator, following the wall clock.
+    The simulator only asks its clock for the time and to sleep, so it can also run on a VirtualClock.
+    """
+    def now(self):
+        return datetime.now()
+
+    def today(self):
+        return self.now().date()
+
+    def sleep(self, duration: timedelta, wakeup: threading.Event = None):
+        """ Sleep for duration, or until wakeup (optional) is set. """
+        if wakeup is None:
+            time.sleep(duration.total_seconds())
+        else:
+            wakeup.wait(duration.total_seconds())
+
+    def wait(self, duration: timedelta, wakeup: threading.Event):
+        """
+        Like sleep, but for waiting on other threads that are working at the current time (e.g. steps of a SimulationHost).
+        Only differs from sleep for clocks that jump ahead, which shouldn't happen while others are still busy.
+        """
+        self.sleep(duration, wakeup)
+
+
+class VirtualClock(Clock):
+    """
+    Clock for replaying traffic faster than real time. Starts at a given time and runs speedup times as fast as the wall clock.
+    Without speedup, time stands still until the simulator sleeps: sleeping returns immediately and jumps ahead instead,
+    so the simulator skips straight to the next notification.
+    """
+    def __init__(self, start: datetime, speedup: float = None):
+        """
+        :param start: time at which the clock starts
+        :param speedup: how much faster than the wall clock time passes, None (or 0) to jump from notification to notification
+        """
+        self.start = start
+        self.speedup = speedup or None
+        self.realStart = time.monotonic()
+        self.skipped = timedelta(0)     # time jumped ahead by sleeping
+        self.lock = threading.Lock()
+
+    def now(self):
+        with self.lock:
+            elapsed = timedelta(0)
+            if self.speedup is not None:
+                elapsed = timedelta(seconds=(time.monotonic() - self.realStart) * self.speedup)
+            return self.start + self.skipped + elapsed
+
+    def sleep(self, duration: timedelta, wakeup: threading.Event = None):
+        if self.speedup is not None:
+            super().sleep(duration / self.speedup, wakeup)
+            return
+
+        if wakeup is not None and wakeup.is_set():
+            return
+        with self.lock:
+            self.skipped += duration
+
+    def wait(self, duration: timedelta, wakeup: threading.Event):
+        if self.speedup is not None:
+            self.sleep(duration, wakeup)
+        else:
+            # time stands still, so only the others can end the wait
+            wakeup.wait()
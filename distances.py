@@ -0,0 +1,112 @@
+import math
+from datetime import timedelta
+
+import numpy as np
+from geopy.distance import distance as geodesic
+
+from settings import DISTANCE_MODE, SPEED
+
+
+# The fast kernels treat the earth as a sphere with the radius of curvature at the latitude of Belgium (Gaussian mean
+# radius), instead of the mean radius of the earth. Over Belgium they stay within 0.2% of the exact (geodesic) distance.
+LATITUDE = 50.5
+_A = 6378.137                           # km, semi-major axis of WGS84
+_E2 = (1 / 298.257223563) * (2 - 1 / 298.257223563)
+_W = 1 - _E2 * math.sin(math.radians(LATITUDE)) ** 2
+EARTH_RADIUS = math.sqrt(_A * (1 - _E2) / _W ** 1.5 * _A / math.sqrt(_W))      # km, sqrt of meridional * normal radius
+KM_PER_DEGREE = math.pi * 6371.0088 / 180                                       # km, for the mean radius of the earth (a lower bound)
+
+
+def haversine(lats1, lons1, lats2, lons2):
+    """ Vectorized great circle distance in km between points given as (arrays of) latitudes and longitudes in degrees. """
+    lats1, lons1, lats2, lons2 = map(np.radians, (lats1, lons1, lats2, lons2))
+    h = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
+
+def equirectangular(lats1, lons1, lats2, lons2):
+    """
+    Vectorized distance in km by projecting on a plane around the mean latitude of both points.
+    Cheaper than haversine and as accurate for distances within a country.
+    """
+    lats1, lons1, lats2, lons2 = map(np.radians, (lats1, lons1, lats2, lons2))
+    x = (lons2 - lons1) * np.cos((lats1 + lats2) / 2)
+    y = lats2 - lats1
+    return EARTH_RADIUS * np.sqrt(x * x + y * y)
+
+
+def fastDistance(a, b):
+    """ Equirectangular distance in km between two (lat, lon) points, without the overhead of numpy for a single pair. """
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    x = (lon2 - lon1) * math.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return EARTH_RADIUS * math.sqrt(x * x + y * y)
+
+
+def exactDistance(a, b):
+    """ Geodesic distance in km between two (lat, lon) points on the WGS84 ellipsoid. """
+    return geodesic(a, b).km
+
+
+def distance(a, b, mode=None):
+    """ Distance in km between two (lat, lon) points, exact or fast depending on mode (default: DISTANCE_MODE). """
+    if (mode or DISTANCE_MODE) == "exact":
+        return exactDistance(a, b)
+    return fastDistance(a, b)
+
+
+def distances(origins, destinations, mode=None):
+    """
+    Distances in km between many pairs of points at once.
+    :param origins: sequence or array (n, 2) of (lat, lon)
+    :param destinations: sequence or array (n, 2) of (lat, lon)
+    :param mode: exact or fast (default: DISTANCE_MODE)
+    :return: array of n distances
+    """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+    destinations = np.asarray(destinations, dtype=float).reshape(-1, 2)
+    if (mode or DISTANCE_MODE) == "exact":
+        return np.array([exactDistance(a, b) for a, b in zip(origins, destinations)])
+    return equirectangular(origins[:, 0], origins[:, 1], destinations[:, 0], destinations[:, 1])
+
+
+class DistanceMatrix(object):
+    """
+    Distances and travel times between all pairs of a small, fixed set of locations (e.g. those of a person).
+    Remembers what it was computed for, so it can tell whether it is still valid (cfr. matches).
+    """
+    def __init__(self, locations, mode=None, speed=SPEED):
+        """
+        :param locations: list of (lat, lon) tuples
+        :param mode: exact or fast (default: DISTANCE_MODE)
+        :param speed: km/s, to compute travel times
+        """
+        locations = [tuple(location) for location in locations]
+        self.key = self.keyOf(locations, mode, speed)
+        self.index = {location: i for i, location in enumerate(locations)}
+        n = len(locations)
+        matrix = distances([a for a in locations for _ in range(n)], [b for _ in range(n) for b in locations], mode).reshape(n, n)
+        self.distances = matrix.tolist()    # nested lists of floats, faster to look up single values than an array
+        self.travelTimes = [[timedelta(seconds=d / speed) for d in row] for row in self.distances]
+
+    @staticmethod
+    def keyOf(locations, mode=None, speed=SPEED):
+        return tuple(tuple(location) for location in locations), mode or DISTANCE_MODE, speed
+
+    def matches(self, locations, mode=None, speed=SPEED):
+        """ Whether this matrix was computed for these locations with the same mode and speed. """
+        return self.key == self.keyOf(locations, mode, speed)
+
+    def distance(self, origin, destination):
+        """ Distance in km between two of the locations, None if either isn't one of them. """
+        i, j = self.index.get(origin), self.index.get(destination)
+        if i is None or j is None:
+            return None
+        return self.distances[i][j]
+
+    def travelTime(self, origin, destination):
+        """ Travel time between two of the locations, None if either isn't one of them. """
+        i, j = self.index.get(origin), self.index.get(destination)
+        if i is None or j is None:
+            return None
+        return self.travelTimes[i][j]
@@ -1,26 +1,67 @@
 import random
 from datetime import datetime, timedelta
 
+import numpy as np
+
 
 class Distribution(object):
-    """ Wrapper class for various statistical distributions """
+    """
+    Wrapper class for various statistical distributions.
+    Besides sampling one value, distributions can be sampled many times at once as numpy arrays (sampleMany). Many
+    distributions of the same class can be sampled at once as well: their parameters are stored as a struct of arrays
+    (cfr. table), which sampleTable samples from without creating objects for every value.
+    """
+    fields = ()         # names of the parameters, in the order of parameters()
+
     def __init__(self):
         pass
 
-    def sample(self):
+    def sample(self, rng=random):
+        """ One sample. rng is a random.Random, e.g. a stream of a person (default: the random module). """
+        raise NotImplementedError()
+
+    def sampleMany(self, n, rng=None):
+        """ n samples as numpy array. rng is a numpy random Generator (default: numpy.random). """
+        return self.sampleTable(self.table([self]), (n,), rng)
+
+    def parameters(self):
+        """ Compact representation of this distribution: a tuple of floats, one for every field. """
+        return tuple(float(getattr(self, field)) for field in self.fields)
+
+    @classmethod
+    def table(cls, distributions):
+        """ Parameters of many distributions of this class as struct of arrays: dict that maps fields -> array with a value per distribution. """
+        values = np.array([distribution.parameters() for distribution in distributions], dtype=float).reshape(len(distributions), len(cls.fields))
+        return {field: values[:, i] for i, field in enumerate(cls.fields)}
+
+    @staticmethod
+    def sampleTable(table, shape, rng=None):
+        """ Sample an array of shape from the distributions in table (cfr. table), which is broadcast to shape. """
         raise NotImplementedError()
 
 
+def generator(rng):
+    return rng if rng is not None else np.random
+
+
 class BernoulliDistribution(Distribution):
+    fields = ("chance",)
+
     def __init__(self, chance):
         super().__init__()
         self.chance = chance
 
-    def sample(self):
-        return random.random() <= self.chance
+    def sample(self, rng=random):
+        return rng.random() <= self.chance
+
+    @staticmethod
+    def sampleTable(table, shape, rng=None):
+        return generator(rng).random(shape) <= table["chance"]
 
 
 class NormalDurationDistribution(Distribution):
+    fields = ("mean", "stddev", "trimSeconds")
+
     def __init__(self, mean, stddev, trimSeconds=True):
         """ mean and stddev in hours """
         super().__init__()
@@ -28,30 +69,104 @@ class NormalDurationDistribution(Distribution):
         self.stddev = stddev
         self.trimSeconds = trimSeconds
 
-    def sample(self):
-        t = timedelta(hours=max(0, random.normalvariate(self.mean, self.stddev)))
+    def sample(self, rng=random):
+        t = timedelta(hours=max(0, rng.normalvariate(self.mean, self.stddev)))
         if self.trimSeconds:
-            return t - timedelta(seconds=t.seconds, microseconds=t.microseconds)
+            return t - timedelta(seconds=t.seconds % 60, microseconds=t.microseconds)
         return t
 
+    @staticmethod
+    def sampleTable(table, shape, rng=None):
+        """ Durations as timedelta64 array. """
+        seconds = np.maximum(0, table["mean"] + generator(rng).standard_normal(shape) * table["stddev"]) * 3600
+        seconds = np.where(table["trimSeconds"] > 0, np.floor(seconds / 60) * 60, seconds)
+        return (seconds * 1e6).astype("timedelta64[us]")
 
-class TimeDistribution(object):
+
+class TimeDistribution(Distribution):
     def __init__(self):
-        pass
+        super().__init__()
 
-    def sample(self, date):
+    def sample(self, date, rng=random):
+        raise NotImplementedError()
+
+    def sampleMany(self, n, rng=None):
+        raise TypeError("Times are sampled for days, cfr. sampleDays")
+
+    def sampleDays(self, dates, rng=None):
+        """ A sample for every date, as datetime64 array. rng is a numpy random Generator (default: numpy.random). """
+        days = np.array(dates, dtype="datetime64[D]")
+        return self.sampleTable(self.table([self]), days, days.shape, rng)
+
+    @staticmethod
+    def sampleTable(table, days, shape, rng=None):
+        """ Sample an array of shape from the distributions in table for days (array of datetime64), both are broadcast to shape. """
         raise NotImplementedError()
 
 
 class NormalTimeDistribution(TimeDistribution):
+    fields = ("mean", "stddev", "trimSeconds")
+
     def __init__(self, mean, stddev, trimSeconds=True):
         super().__init__()
         self.mean = mean
         self.stddev = stddev
         self.trimSeconds = trimSeconds
 
-    def sample(self, date):
-        t = random.normalvariate(datetime.combine(date, self.mean), self.stddev)
+    def sample(self, date, rng=random):
+        t = rng.normalvariate(datetime.combine(date, self.mean), self.stddev)
         if self.trimSeconds:
             return t.replace(second=0, microsecond=0)
         return t
+
+    def parameters(self):
+        """ Mean as seconds since midnight, stddev in seconds. """
+        mean = timedelta(hours=self.mean.hour, minutes=self.mean.minute, seconds=self.mean.second, microseconds=self.mean.microsecond)
+        return mean.total_seconds(), self.stddev.total_seconds(), float(self.trimSeconds)
+
+    @staticmethod
+    def sampleTable(table, days, shape, rng=None):
+        """ Times as datetime64 array. """
+        seconds = table["mean"] + generator(rng).standard_normal(shape) * table["stddev"]
+        seconds = np.where(table["trimSeconds"] > 0, np.floor(seconds / 60) * 60, seconds)
+        return days.astype("datetime64[us]") + (seconds * 1e6).astype("timedelta64[us]")
+
+
+class AliasDistribution(Distribution):
+    """
+    Discrete distribution over 0 .. len(weights) - 1, proportional to weights.
+    Sampled in O(1) per value, whatever the amount of values, with an alias table (Vose's alias method): every slot holds
+    a value, the chance to keep it and the value it is otherwise replaced by.
+    """
+    def __init__(self, weights):
+        super().__init__()
+        weights = np.asarray(weights, dtype=float)
+        n = len(weights)
+        scaled = (weights * n / weights.sum()).tolist()
+        self.chances = [1.0] * n        # chance to keep the value of a slot
+        self.aliases = list(range(n))   # value of a slot otherwise
+
+        small = [i for i, chance in enumerate(scaled) if chance < 1]
+        large = [i for i, chance in enumerate(scaled) if chance >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.chances[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # what is left has chance 1 (up to rounding errors)
+
+        self.chanceArray = np.array(self.chances)
+        self.aliasArray = np.array(self.aliases)
+
+    def __len__(self):
+        return len(self.chances)
+
+    def sample(self, rng=random):
+        slot = rng.randrange(len(self.chances))
+        return slot if rng.random() < self.chances[slot] else self.aliases[slot]
+
+    def sampleMany(self, n, rng=None):
+        rng = generator(rng)
+        slots = (rng.random(n) * len(self.chances)).astype(int)
+        return np.where(rng.random(n) < self.chanceArray[slots], slots, self.aliasArray[slots])
@@ -1,28 +1,43 @@
+import os
 import logging
+import multiprocessing
 
 import bacli
 import names
+import numpy
 import username_generator
 import random
 
 import geometry
+from person import Person
+from personStore import PersonStore
 from personGenerator import WorkerPersonGenerator
+from settings import MAX_ATTEMPTS, PEOPLE_STORE
 
 
 logging.basicConfig(format='%(asctime)s - %(name)s [%(levelname)s]: %(message)s', level=logging.DEBUG)
 
 
-def generatePerson():
-	""" Generates a random WorkerPerson and returns it. """
+def generateUsername():
+	return username_generator.get_uname(0, 255, False)
+
+
+def generatePerson(username=None, home=None, locations=None):
+	"""
+	Generates a random WorkerPerson and returns it.
+	Username, home and other locations (work, hobbyLocations) can be given when they were sampled in batch, otherwise they are sampled here.
+	"""
 	gender = random.choice(('male', 'female'))
 	firstname = names.get_first_name(gender)
 	lastname = names.get_last_name()
 	password = "password"
-	username = username_generator.get_uname(0, 255, False)
-	home = geometry.sampleRandomLocation()
+	if username is None:
+		username = generateUsername()
+	if home is None:
+		home = geometry.toTuples(geometry.sampleHomes(1))[0]
 	detourTolerance = min(1.2, random.normalvariate(1.7, 0.5))
 
-	person = WorkerPersonGenerator().generate(firstname, lastname, username, gender, password, home, detourTolerance)
+	person = WorkerPersonGenerator().generate(firstname, lastname, username, gender, password, home, detourTolerance, locations)
 
 	# logging.debug(person.home)
 	# logging.debug(person.work)
@@ -31,16 +46,81 @@ def generatePerson():
 	return person
 
 
+def generateUniqueUsernames(amount, existing=()):
+	""" Generates exactly amount distinct usernames that do not occur in existing. """
+	existing = set(existing)
+	usernames = list()
+	for _ in range(amount * MAX_ATTEMPTS):
+		if len(usernames) == amount:
+			break
+		username = generateUsername()
+		if username not in existing:
+			existing.add(username)
+			usernames.append(username)
+
+	if len(usernames) < amount:
+		logging.error(f"Couldn't generate {amount} unique usernames in {amount * MAX_ATTEMPTS} tries")
+		raise RuntimeError(f"Couldn't generate {amount} unique usernames in {amount * MAX_ATTEMPTS} tries")
+
+	return usernames
+
+
+def generateChunk(storePath, usernames, seed):
+	"""
+	Generates people with the given usernames and adds them to the store at once. Used as unit of work for the worker processes.
+	Both random generators are seeded, so the outcome of a chunk only depends on its seed.
+	"""
+	random.seed(seed)
+	numpy.random.seed(seed)
+
+	# sample all locations in batch, this is much faster than point per point
+	homes = geometry.sampleHomes(len(usernames))
+	locations = WorkerPersonGenerator().sampleLocations(homes)
+	people = [generatePerson(username, home, personLocations) for username, home, personLocations in zip(usernames, geometry.toTuples(homes), locations)]
+
+	with PersonStore(storePath) as store:
+		store.addAll(people)
+	return len(people)
+
+
 # utility module for turning functions into command line interface (cli) commands
 with bacli.cli() as cli:
 
 	@cli.command
-	def generatePeople(directory: str, amount: int = 1):
-		""" generates people in the specified directory. """
+	def generatePeople(directory: str, amount: int = 1, workers: int = 1, chunkSize: int = 500, seed: int = None):
+		"""
+		generates people in the store of the specified directory.
+		Work is split in chunks of chunkSize people over a pool of workers processes. Give a seed for reproducible output.
+		"""
 		logging.info(f"Generating {amount} people.")
-		for i in range(amount):
-			person = generatePerson()
-			person.saveTo(directory)
+		master = random.Random(seed)
+
+		storePath = os.path.join(directory, PEOPLE_STORE)
+		with PersonStore(storePath) as store:
+			existing = store.usernames()
+		existing += [os.path.splitext(os.path.basename(f))[0] for f in Person.listFiles(directory)]
 
+		# usernames are decided up front, so every chunk can work independently
+		random.seed(master.randrange(2**32))
+		usernames = generateUniqueUsernames(amount, existing)
 
+		chunks = [usernames[i:i + chunkSize] for i in range(0, amount, chunkSize)]
+		tasks = [(storePath, chunk, master.randrange(2**32)) for chunk in chunks]
 
+		if workers <= 1:
+			for task in tasks:
+				generateChunk(*task)
+				logging.debug(f"Generated chunk of {len(task[1])} people")
+			return
+
+		# fork explicitly: other start methods re-import this script, which would run the cli again
+		with multiprocessing.get_context("fork").Pool(workers) as pool:
+			generated = sum(pool.starmap(generateChunk, tasks, chunksize=1))
+		logging.info(f"Generated {generated} people in {len(tasks)} chunks")
+
+	@cli.command
+	def migratePeople(directory: str):
+		""" moves people saved as separate files in the specified directory to the store in that directory. """
+		with PersonStore(os.path.join(directory, PEOPLE_STORE)) as store:
+			amount = store.migrateFrom(directory)
+		logging.info(f"Migrated {amount} people.")
@@ -1,14 +1,203 @@
-import random
+import os
 import math
 import logging
 
-import pycristoforo as pyc
-from scipy.stats import gamma
-from shapely.geometry import Point
+import numpy as np
+from shapely import wkb
+try:
+    # shapely 2 tests points against geometries prepared in place, shapely.vectorized is deprecated since
+    from shapely import contains_xy as contains, prepare
 
-from settings import MAX_ATTEMPTS
+    def prep(shape):
+        prepare(shape)
+        return shape
+except ImportError:
+    from shapely.prepared import prep
+    from shapely.vectorized import contains
 
-BE = pyc.get_shape("Belgium")
+import population
+from distribution import AliasDistribution
+from settings import MAX_ATTEMPTS, LAND_MASK_FILE, LAND_MASK_RESOLUTION, POPULATION_WEIGHTED, POPULATION_RESOLUTION, NEAR_CANDIDATES
+
+
+class LandMask(object):
+    """
+    Shape of a country with a raster over its bounding box, of which every cell is OUTSIDE, INSIDE or on the BORDER.
+    Points in cells that are entirely in or out are decided by the raster alone, only points in border cells are tested
+    against the (prepared) shape. Masks are built once and saved as a small file (cfr. save and load).
+    """
+    OUTSIDE, INSIDE, BORDER = 0, 1, 2
+
+    def __init__(self, shape, origin, resolution, cells):
+        """
+        :param shape: shapely (multi)polygon with (lon, lat) coordinates
+        :param origin: (lon, lat) of the corner of the raster with the lowest coordinates
+        :param resolution: size of the cells in degrees
+        :param cells: uint8 array (rows by latitude, columns by longitude) of OUTSIDE, INSIDE or BORDER
+        """
+        self.shape = shape
+        self.prepared = prep(shape)     # prepared geometry speeds up repeated containment tests considerably
+        self.origin = origin
+        self.resolution = resolution
+        self.cells = cells
+
+    @classmethod
+    def build(cls, shape, resolution):
+        """
+        Cells the boundary of shape passes through are BORDER, the others are decided by their centre. The boundary is
+        sampled more densely than the cells and the cells around those samples are border cells as well, so no cell the
+        boundary clips is missed.
+        """
+        minLon, minLat, maxLon, maxLat = shape.bounds
+        rows = math.ceil((maxLat - minLat) / resolution) + 1
+        cols = math.ceil((maxLon - minLon) / resolution) + 1
+        lons, lats = np.meshgrid(minLon + (np.arange(cols) + 0.5) * resolution, minLat + (np.arange(rows) + 0.5) * resolution)
+        cells = np.where(contains(prep(shape), lons, lats), cls.INSIDE, cls.OUTSIDE).astype(np.uint8)
+
+        border = np.zeros((rows + 2, cols + 2), dtype=bool)     # padded by a cell on every side for the neighbours below
+        polygons = shape.geoms if hasattr(shape, "geoms") else [shape]
+        for ring in [ring for polygon in polygons for ring in (polygon.exterior, *polygon.interiors)]:
+            coords = np.asarray(ring.coords)
+            starts, deltas = coords[:-1], coords[1:] - coords[:-1]
+            steps = np.maximum(1, np.ceil(np.hypot(deltas[:, 0], deltas[:, 1]) / (resolution / 4))).astype(int)
+            segments = np.repeat(np.arange(len(steps)), steps)
+            fractions = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / steps[segments]
+            points = starts[segments] + deltas[segments] * fractions[:, None]
+            border[np.floor((points[:, 1] - minLat) / resolution).astype(int) + 1, np.floor((points[:, 0] - minLon) / resolution).astype(int) + 1] = True
+
+        nearBorder = np.zeros((rows, cols), dtype=bool)
+        for i in range(3):
+            for j in range(3):
+                nearBorder |= border[i:i + rows, j:j + cols]
+        cells[nearBorder] = cls.BORDER
+        return cls(shape, (minLon, minLat), resolution, cells)
+
+    def save(self, filename):
+        """ Save to a compressed numpy file, written aside first so a mask that is being saved is never loaded. """
+        temporary = filename + ".tmp.npz"
+        np.savez_compressed(temporary, shape=np.frombuffer(wkb.dumps(self.shape), dtype=np.uint8), origin=np.array(self.origin),
+                            resolution=np.array(self.resolution), cells=self.cells)
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(wkb.loads(data["shape"].tobytes()), tuple(data["origin"]), float(data["resolution"]), data["cells"])
+
+    def contains(self, lats, lons):
+        """ Vectorized check whether coordinates lie within the shape. Returns a boolean array. """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        rows = np.floor((lats - self.origin[1]) / self.resolution).astype(int)
+        cols = np.floor((lons - self.origin[0]) / self.resolution).astype(int)
+        inRaster = (rows >= 0) & (rows < self.cells.shape[0]) & (cols >= 0) & (cols < self.cells.shape[1])
+
+        states = np.full(lats.shape, self.OUTSIDE, dtype=np.uint8)
+        states[inRaster] = self.cells[rows[inRaster], cols[inRaster]]
+        result = states == self.INSIDE
+        border = states == self.BORDER
+        if border.any():
+            result[border] = contains(self.prepared, lons[border], lats[border])
+        return result
+
+
+def loadBelgium():
+    """
+    The land mask of Belgium from LAND_MASK_FILE next to this module. Without one (or with another resolution) it is
+    built from the shape of pycristoforo, which is slow to load, and saved for next time.
+    """
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), LAND_MASK_FILE)
+    if os.path.exists(filename):
+        try:
+            mask = LandMask.load(filename)
+            if mask.resolution == LAND_MASK_RESOLUTION:
+                return mask
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Rebuilding land mask, couldn't load {filename}: {e!r}")
+
+    import pycristoforo as pyc
+    mask = LandMask.build(pyc.get_shape("Belgium"), LAND_MASK_RESOLUTION)
+    try:
+        mask.save(filename)
+    except OSError as e:
+        logging.warning(f"Couldn't save land mask to {filename}: {e!r}")
+    return mask
+
+
+class PopulationGrid(object):
+    """
+    Coarse raster of the amount of inhabitants per cell, to sample locations where people live: a cell is drawn from an
+    alias table (cfr. AliasDistribution) in O(1), after which the location is spread uniformly within the cell.
+    """
+    def __init__(self, origin, resolution, inhabitants):
+        """
+        :param origin: (lon, lat) of the corner of the raster with the lowest coordinates
+        :param resolution: size of the cells in degrees
+        :param inhabitants: array (rows by latitude, columns by longitude) of the (relative) amount of inhabitants per cell
+        """
+        self.origin = origin
+        self.resolution = resolution
+        self.inhabitants = inhabitants
+        self.populated = np.flatnonzero(inhabitants)        # only populated cells are in the alias table
+        self.cells = AliasDistribution(inhabitants.ravel()[self.populated])
+
+    @classmethod
+    def build(cls, landMask, resolution):
+        """ Inhabitants per cell from the density of population.py, in proportion to the part of the cell on land. """
+        minLon, minLat, maxLon, maxLat = landMask.shape.bounds
+        rows = math.ceil((maxLat - minLat) / resolution)
+        cols = math.ceil((maxLon - minLon) / resolution)
+        lons, lats = np.meshgrid(minLon + (np.arange(cols) + 0.5) * resolution, minLat + (np.arange(rows) + 0.5) * resolution)
+
+        # part of every cell on land, from a 4 by 4 grid of points within it
+        offsets = (np.arange(4) + 0.5) / 4 - 0.5
+        onLand = np.zeros((rows, cols))
+        for latOffset in offsets:
+            for lonOffset in offsets:
+                onLand += landMask.contains(lats + latOffset * resolution, lons + lonOffset * resolution)
+
+        cellArea = (resolution * population.KM_PER_DEGREE) ** 2 * np.cos(np.radians(lats))
+        return cls((minLon, minLat), resolution, population.density(lats, lons) * cellArea * onLand / 16)
+
+    def inhabitantsAt(self, lats, lons):
+        """ Vectorized (relative) amount of inhabitants of the cells of coordinates, 0 outside the raster. """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        rows = np.floor((lats - self.origin[1]) / self.resolution).astype(int)
+        cols = np.floor((lons - self.origin[0]) / self.resolution).astype(int)
+        inRaster = (rows >= 0) & (rows < self.inhabitants.shape[0]) & (cols >= 0) & (cols < self.inhabitants.shape[1])
+        result = np.zeros(lats.shape)
+        result[inRaster] = self.inhabitants[rows[inRaster], cols[inRaster]]
+        return result
+
+    def sample(self, n):
+        """ n points on land, weighted by population, as an array of shape (n, 2) with (lat, lon) rows. """
+        points = np.empty((n, 2))
+        missing = np.arange(n)
+        for _ in range(MAX_ATTEMPTS):
+            if len(missing) == 0:
+                break
+
+            rows, cols = np.divmod(self.populated[self.cells.sampleMany(len(missing))], self.inhabitants.shape[1])
+            lats = self.origin[1] + (rows + np.random.random(len(missing))) * self.resolution
+            lons = self.origin[0] + (cols + np.random.random(len(missing))) * self.resolution
+
+            # cells on the coast or the border are partly on land
+            onLand = isOnLand(lats, lons)
+            points[missing[onLand], 0] = lats[onLand]
+            points[missing[onLand], 1] = lons[onLand]
+            missing = missing[~onLand]
+
+        if len(missing) > 0:
+            logging.error(f"Couldn't sample {n} populated points in {MAX_ATTEMPTS} rounds")
+            raise RuntimeError(f"Couldn't sample {n} populated points in {MAX_ATTEMPTS} rounds")
+
+        return points
+
+
+BELGIUM = loadBelgium()
+BE = BELGIUM.shape
+POPULATION = PopulationGrid.build(BELGIUM, POPULATION_RESOLUTION)
 
 
 def convertPoint(point):
@@ -16,28 +205,110 @@ def convertPoint(point):
     return tuple(reversed(point['geometry']['coordinates']))
 
 
+def toTuples(points):
+    """ Converts an array of (lat, lon) rows to a list of tuples with plain floats (as used by the rest of the code). """
+    return [tuple(point) for point in np.asarray(points).tolist()]
+
+
+def isOnLand(lats, lons):
+    """ Vectorized check whether coordinates lie within Belgium. Returns a boolean array. """
+    return BELGIUM.contains(lats, lons)
+
+
+def sampleRandomLocations(n):
+    """
+    Gets n uniformly random points in Belgium as an array of shape (n, 2) with (lat, lon) rows.
+    Candidates are drawn in bulk from the bounding box and rejected if they are not on land.
+    """
+    minLon, minLat, maxLon, maxLat = BE.bounds
+    acceptRate = BE.area / ((maxLon - minLon) * (maxLat - minLat))
+
+    points = np.empty((n, 2))
+    found = 0
+    for _ in range(MAX_ATTEMPTS):
+        if found == n:
+            break
+
+        # oversample a bit, so one round is typically enough
+        amount = math.ceil((n - found) / acceptRate * 1.1) + 8
+        lats = np.random.uniform(minLat, maxLat, amount)
+        lons = np.random.uniform(minLon, maxLon, amount)
+        onLand = isOnLand(lats, lons)
+
+        accepted = np.column_stack((lats[onLand], lons[onLand]))[:n - found]
+        points[found:found + len(accepted)] = accepted
+        found += len(accepted)
+
+    if found < n:
+        logging.error(f"Couldn't sample {n} random points in {MAX_ATTEMPTS} rounds")
+        raise RuntimeError(f"Couldn't sample {n} random points in {MAX_ATTEMPTS} rounds")
+
+    return points
+
+
 def sampleRandomLocation():
     """ Gets a single random point in Belgium. """
-    # Note: quite inefficient, because function builds shape for every call.
-    points = pyc.geoloc_generation(BE, 1, "Belgium")
-    return convertPoint(points[0])
+    return toTuples(sampleRandomLocations(1))[0]
 
 
-def sampleLocationNear(origin, distanceScale=1):
+def sampleHomes(n):
+    """ Gets n homes in Belgium as an array of shape (n, 2), where people live if POPULATION_WEIGHTED, uniform otherwise. """
+    if POPULATION_WEIGHTED:
+        return POPULATION.sample(n)
+    return sampleRandomLocations(n)
+
+
+def sampleLocationsNear(origins, distanceScale=1, n=1):
     """
-    Sample for a location from a gamma distribution around another point.
+    Sample n locations from a gamma distribution around every origin at once.
     Uses a polar coordinate approximation which is accurate enough for small regions (cfr. Belgium), where the curvature has minimal impact.
-    :param origin: source point
-    :param distanceScale: modifier for how far the point is allowed to be
+    If POPULATION_WEIGHTED, NEAR_CANDIDATES are sampled for every location, of which one is picked in proportion to the
+    inhabitants around it (cfr. POPULATION): people work and spend their free time where other people live as well.
+    Every location gets MAX_ATTEMPTS tries to land in Belgium, just like sampleLocationNear.
+    :param origins: sequence of source points (lat, lon)
+    :param distanceScale: modifier for how far the points are allowed to be
+    :param n: amount of points to sample per origin
+    :return: array of shape (len(origins), n, 2) with (lat, lon) as last dimension
     """
+    origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+    points = np.empty((len(origins), n, 2))
+    missing = np.ones((len(origins), n), dtype=bool)
+
+    candidates = NEAR_CANDIDATES if POPULATION_WEIGHTED else 1
     for _ in range(MAX_ATTEMPTS):
-        angle = random.uniform(0, 2 * math.pi)
-        distance = gamma.rvs(a=2, loc=0.01, scale=0.1 * distanceScale)
-        point = (origin[0] + math.cos(angle) * distance, origin[1] + math.sin(angle) * distance)
+        rows, cols = np.nonzero(missing)
+        if len(rows) == 0:
+            break
+
+        size = (len(rows), candidates)
+        angles = np.random.uniform(0, 2 * math.pi, size)
+        distances = 0.01 + np.random.gamma(2, 0.1 * distanceScale, size)     # gamma with a=2, loc=0.01
+        lats = origins[rows, 0, None] + np.cos(angles) * distances
+        lons = origins[rows, 1, None] + np.sin(angles) * distances
+
+        # Check if on land, and pick one of the candidates that are
+        weights = isOnLand(lats, lons) * (POPULATION.inhabitantsAt(lats, lons) if POPULATION_WEIGHTED else 1.0)
+        cumulative = np.cumsum(weights, axis=1)
+        found = cumulative[:, -1] > 0
+        picked = np.minimum((cumulative < np.random.random(len(rows))[:, None] * cumulative[:, -1:]).sum(axis=1), candidates - 1)
+        indices = np.arange(len(rows))[found]
+        rows, cols, picked = rows[found], cols[found], picked[found]
+        points[rows, cols, 0] = lats[indices, picked]
+        points[rows, cols, 1] = lons[indices, picked]
+        missing[rows, cols] = False
+
+    if missing.any():
+        origin = tuple(origins[np.nonzero(missing)[0][0]])
+        logging.error(f"Couldn't sample random point near {origin} with scale {distanceScale} in {MAX_ATTEMPTS} tries")
+        raise RuntimeError(f"Couldn't sample random point near {origin} with scale {distanceScale} in {MAX_ATTEMPTS} tries")
 
-        # Check if on land
-        if BE.contains(Point(*reversed(point))):
-            return point
+    return points
 
-    logging.error(f"Couldn't sample random point near {origin} with scale {distanceScale} in {MAX_ATTEMPTS} tries")
-    raise RuntimeError(f"Couldn't sample random point near {origin} with scale {distanceScale} in {MAX_ATTEMPTS} tries")
+
+def sampleLocationNear(origin, distanceScale=1):
+    """
+    Sample for a location from a gamma distribution around another point.
+    :param origin: source point
+    :param distanceScale: modifier for how far the point is allowed to be
+    """
+    return toTuples(sampleLocationsNear([origin], distanceScale, 1)[0])[0]
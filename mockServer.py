@@ -0,0 +1,287 @@
+import re
+import json
+import time
+import random
+import logging
+import secrets
+import threading
+import itertools
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from settings import LOGIN_PATH, REGISTER_PATH, DRIVES_PATH, SEARCH_PATH, PASSENGER_REQUEST_PATH, REQUEST_STATUS_PATH
+from rideIndex import RideIndex
+
+
+class ApiError(Exception):
+    """ Error that is answered with an http status. """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def pathPattern(template):
+    """
+    Regex for a path of the settings, e.g. drives/{drive_id}/passenger-requests, with its parameters as named groups.
+    Any prefix is accepted, so the webservice can live under e.g. /api/.
+    """
+    return re.compile("(?:^|/)" + re.sub(r"\\{(\w+)\\}", r"(?P<\1>[^/]+)", re.escape(template)) + "/?$")
+
+
+def parsePoint(value):
+    """ A (lat, lon) point from a json list or from query values (either 'lat,lon' or the two coordinates repeated). """
+    if isinstance(value, str):
+        value = value.split(",")
+    lat, lon = value
+    return float(lat), float(lon)
+
+
+class MockApi(object):
+    """
+    In memory stand-in for the carpool webservice, implementing the endpoints of settings.py.
+    Search finds rides that arrive within SEARCH_WINDOW of the requested time, start and end within
+    SEARCH_RADIUS of the requested locations and have places left, closest first. Drives are indexed (cfr. RideIndex),
+    so searching stays fast with many drives.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = dict()             # maps usernames -> user data
+        self.tokens = dict()            # maps tokens -> userIds
+        self.drives = dict()            # maps driveIds -> drive data
+        self.index = RideIndex()        # drives by origin, destination and arrival time
+        self.userIds = itertools.count(1)
+        self.driveIds = itertools.count(1)
+
+    def authenticate(self, headers):
+        """ Returns the userId of the bearer token in headers. """
+        authorization = headers.get("Authorization", "")
+        userId = self.tokens.get(authorization[len("Bearer "):]) if authorization.startswith("Bearer ") else None
+        if userId is None:
+            raise ApiError(401, "Invalid or missing token")
+        return userId
+
+    def register(self, data):
+        with self.lock:
+            if data.get("username") in self.users:
+                raise ApiError(409, "Username already taken")
+            user = dict(data, id=next(self.userIds))
+            self.users[user["username"]] = user
+        return 201, {"id": user["id"]}
+
+    def login(self, data):
+        with self.lock:
+            user = self.users.get(data.get("username"))
+            if user is None or user["password"] != data.get("password"):
+                raise ApiError(401, "Wrong username or password")
+            token = secrets.token_hex(16)
+            self.tokens[token] = user["id"]
+        return 200, {"token": token}
+
+    def addDrive(self, data, userId):
+        drive = {
+            "id": next(self.driveIds),
+            "driver-id": userId,
+            "from": parsePoint(data["from"]),
+            "to": parsePoint(data["to"]),
+            "arrive-by": data["arrive-by"],
+            "passenger-places": data["passenger-places"],
+            "passenger-ids": list(),
+            "passenger-requests": dict(),   # maps userIds -> status
+        }
+        arriveBy = datetime.fromisoformat(drive["arrive-by"])
+        with self.lock:
+            self.drives[drive["id"]] = drive
+        self.index.add(drive["id"], drive["from"], drive["to"], arriveBy, drive)
+        return 201, self.publicDrive(drive)
+
+    def search(self, query):
+        origin = parsePoint(query["from"])
+        destination = parsePoint(query["to"])
+        arriveBy = datetime.fromisoformat(query["arrive_by"])
+        limit = int(query.get("limit", 5))
+
+        drives = list()
+        for _, _, drive in self.index.search(origin, destination, arriveBy):
+            with self.lock:
+                if len(drive["passenger-ids"]) < drive["passenger-places"]:
+                    drives.append(self.publicDrive(drive))
+            if len(drives) == limit:
+                break
+        return 200, drives
+
+    def requestPassage(self, data, userId, drive_id):
+        with self.lock:
+            drive = self.findDrive(drive_id)
+            if drive["driver-id"] == userId:
+                raise ApiError(400, "Can't join own drive")
+            drive["passenger-requests"][userId] = "pending"
+        return 201, {"drive-id": drive["id"], "user-id": userId, "status": "pending"}
+
+    def respondToRequest(self, data, userId, drive_id, user_id):
+        action = data.get("action")
+        if action not in ("accept", "reject"):
+            raise ApiError(400, "Action should be accept or reject")
+        with self.lock:
+            drive = self.findDrive(drive_id)
+            if drive["driver-id"] != userId:
+                raise ApiError(403, "Only the driver can respond to requests")
+            passengerId = int(user_id) if user_id.isdigit() else user_id
+            if passengerId not in drive["passenger-requests"]:
+                raise ApiError(404, "No such passenger request")
+            if action == "accept":
+                if len(drive["passenger-ids"]) >= drive["passenger-places"]:
+                    raise ApiError(409, "Drive is full")
+                drive["passenger-ids"].append(passengerId)
+            drive["passenger-requests"][passengerId] = action + "ed"
+        return 200, {"drive-id": drive["id"], "user-id": passengerId, "status": action + "ed"}
+
+    def findDrive(self, driveId):
+        drive = self.drives.get(int(driveId)) if str(driveId).isdigit() else None
+        if drive is None:
+            raise ApiError(404, "No such drive")
+        return drive
+
+    @staticmethod
+    def publicDrive(drive):
+        return {key: list(value) if key == "passenger-ids" else value for key, value in drive.items() if key != "passenger-requests"}
+
+
+# method, path, name of MockApi method, whether the request needs a token
+ROUTES = [
+    ("POST", pathPattern(REGISTER_PATH), "register", False),
+    ("POST", pathPattern(LOGIN_PATH), "login", False),
+    ("GET", pathPattern(SEARCH_PATH), "search", False),
+    ("POST", pathPattern(DRIVES_PATH), "addDrive", True),
+    ("POST", pathPattern(PASSENGER_REQUEST_PATH), "requestPassage", True),
+    ("POST", pathPattern(REQUEST_STATUS_PATH), "respondToRequest", True),
+]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """ Routes requests to the MockApi of the server, after the injected latency and errors. """
+    protocol_version = "HTTP/1.1"       # keep connections alive, like the real webservice
+    disable_nagle_algorithm = True      # headers and body are written separately, don't wait for acks in between
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        for routeMethod, pattern, name, needsToken in ROUTES:
+            match = pattern.search(url.path)
+            if routeMethod == method and match:
+                break
+        else:
+            name, match = None, None
+
+        self.server.delay()
+        try:
+            if name is None:
+                raise ApiError(404, f"No route for {method} {url.path}")
+            if self.server.fail():
+                raise ApiError(503, "Injected error")
+
+            handler = getattr(self.server.api, name)
+            if method == "GET":
+                data = {key: values if len(values) > 1 else values[0] for key, values in parse_qs(url.query).items()}
+            else:
+                data = json.loads(body) if body else dict()
+            if needsToken:
+                status, response = handler(data, self.server.api.authenticate(self.headers), **match.groupdict())
+            else:
+                status, response = handler(data)
+        except ApiError as e:
+            status, response = e.status, {"error": str(e)}
+        except (KeyError, ValueError, TypeError) as e:
+            status, response = 400, {"error": f"Bad request: {e!r}"}
+
+        self.server.record(name, status)
+        self.respond(status, response)
+
+    def respond(self, status, response):
+        content = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Mock webservice: {format % args}")
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Local webservice (cfr. MockApi) to run the simulator against without a team server, e.g. for benchmarks.
+    Every request is delayed by a random latency and fails with 503 at a given rate.
+    """
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, errorRate=0.0, api=None):
+        """
+        :param port: port to listen on, 0 picks a free one (cfr. url)
+        :param latency: mean latency of a request in seconds, exponentially distributed
+        :param errorRate: fraction of requests that fail with 503
+        """
+        super().__init__((host, port), MockRequestHandler)
+        self.api = api if api is not None else MockApi()
+        self.latency = latency
+        self.errorRate = errorRate
+        self.counts = Counter()     # maps (route, status) -> amount of requests
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/"
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(random.expovariate(1 / self.latency))
+
+    def fail(self):
+        return self.errorRate > 0 and random.random() < self.errorRate
+
+    def record(self, route, status):
+        with self.lock:
+            self.counts[(route, status)] += 1
+
+    def start(self):
+        """ Serve in a background thread. """
+        self.thread = threading.Thread(target=self.serve_forever, name="MockServer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    # only when run as script, the simulator imports this module for its benchmark
+    import bacli
+
+    with bacli.cli() as cli:
+
+        @cli.command
+        def serve(port: int = 8000, latency: float = 0.0, errorRate: float = 0.0):
+            """
+            Run the mock webservice on localhost:port, e.g. for 'simulator.py replay'.
+            Requests take latency seconds on average and errorRate of them fail with 503.
+            """
+            logging.basicConfig(level=logging.INFO)
+            server = MockServer(port=port, latency=latency, errorRate=errorRate)
+            logging.info(f"Mock webservice at {server.url}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                logging.info("Shutting down")
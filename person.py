@@ -1,11 +1,15 @@
 import pickle
 import random
+import hashlib
 import logging
 import os
 from os.path import isfile
 from datetime import timedelta
 
 from ride import Ride
+import batchGeneration
+from distances import DistanceMatrix
+from settings import MINIMUM_TRAVEL_MARGIN
 
 
 class Person(object):
@@ -27,6 +31,20 @@ class Person(object):
         self.home = home
         self.detourTolerance = detourTolerance      # margin for how large a detour a ride request can be
         self.activities = list()
+        self.distanceMatrix = None                  # distances between locations, persisted with the person (cfr. cacheDistances)
+        self.seed = random.getrandbits(64)          # rides of a day are generated from streams seeded by this and the day (cfr. rngFor, batchGeneration.DayStreams)
+
+    def __setstate__(self, state):
+        """
+        Recompute cached distances on load if they're missing (older people) or outdated (locations or settings changed).
+        Older people get a seed derived from their username, so it is the same every time they are loaded.
+        """
+        self.__dict__.update(state)
+        if "seed" not in state:
+            self.seed = int.from_bytes(hashlib.sha256(self.username.encode()).digest()[:8], "big")
+        matrix = state.get("distanceMatrix")
+        if matrix is None or not matrix.matches(self.locations):
+            self.cacheDistances()
 
     def __eq__(self, other):
         return self.username == other.username
@@ -50,10 +68,15 @@ class Person(object):
         """ Save person to file. Rides are not stored with the person itself. """
         pickle.dump(self, open(os.path.join(directory, str(self.username) + ".pickle"), "wb"))
 
+    @staticmethod
+    def listFiles(directory):
+        """ Lists the files of people saved in a directory. """
+        return [os.path.join(directory, f) for f in os.listdir(directory) if isfile(os.path.join(directory, f)) and f.endswith(".pickle")]
+
     @staticmethod
     def loadAllFrom(directory):
         """ Loads all people from a directory. """
-        files = [os.path.join(directory, f) for f in os.listdir(directory) if isfile(os.path.join(directory, f))]
+        files = Person.listFiles(directory)
         people = [Person.loadFrom(file) for file in files]
         return people
 
@@ -61,6 +84,27 @@ class Person(object):
         """ Utility function to have the person label coordinates (for pretty printing of rides). """
         return "Home" if location == self.home else location
 
+    @property
+    def locations(self):
+        """ Fixed locations of this person, between which distances are cached. """
+        return [self.home]
+
+    def cacheDistances(self):
+        """ (Re)compute the distances between the locations of this person. Needed after changing locations. """
+        self.distanceMatrix = DistanceMatrix(self.locations)
+
+    def distanceBetween(self, origin, destination):
+        """ Cached distance in km between two locations of this person, None if either isn't one of them. """
+        if self.distanceMatrix is None:
+            self.cacheDistances()
+        return self.distanceMatrix.distance(origin, destination)
+
+    def travelTimeBetween(self, origin, destination):
+        """ Cached travel time between two locations of this person, None if either isn't one of them. """
+        if self.distanceMatrix is None:
+            self.cacheDistances()
+        return self.distanceMatrix.travelTime(origin, destination)
+
     def getAdditionalData(self):
         """ Return a dictionary with extra information that should be added when registering. """
         return {
@@ -68,43 +112,98 @@ class Person(object):
             "gender": self.gender
         }
 
-    def generateRidesForDay(self, day):
-        """ Have a person iterate over their activities to generate potential rides for one day. """
+    def rngFor(self, day):
+        """ Random stream of day: the same for the same seed and day, so the rides of a day can be generated again. """
+        return random.Random(f"{self.seed}:{day.isoformat()}")
 
-        rides = list()
+    @property
+    def reproducible(self):
+        """
+        Whether generating the rides of a day again gives the same rides (cfr. rngFor). Subclasses that generate rides
+        or notification times in their own way aren't, unless they override this.
+        """
+        cls = type(self)
+        return cls.generateRidesForDay is Person.generateRidesForDay and cls.addNotificationTime is Person.addNotificationTime
 
-        # current location (starts from home every day)
-        origin = self.home
+    @property
+    def batchable(self):
+        """
+        Whether the rides of a day are generated by batchGeneration instead of generateRidesForDay: the person makes rides
+        the default way, from activities with exactly the distributions it samples, between locations with cached distances.
+        """
+        if not (self.reproducible and type(self).ridesForVisits is Person.ridesForVisits):
+            return False
+        if self.distanceMatrix is None:
+            self.cacheDistances()
+        known = self.distanceMatrix.index
+        return tuple(self.home) in known and all(
+            batchGeneration.isBatchable(activity) and all(tuple(location) in known for location in activity.locations) for activity in self.activities
+        )
 
-        # ride back, if any
-        returnRide = None
+    @property
+    def fingerprint(self):
+        """
+        Digest of everything the rides of a day are generated from: how they are generated (cfr. batchable), the seed, the
+        activities and the travel times between locations (cfr. DistanceMatrix.key). Rides generated with another fingerprint can't be generated again (cfr. StateStore).
+        """
+        data = (type(self).__qualname__, self.batchable, self.seed, self.home, self.passengers, self.activities,
+                DistanceMatrix.keyOf(self.locations), MINIMUM_TRAVEL_MARGIN)
+        return hashlib.sha256(pickle.dumps(data, protocol=4)).hexdigest()[:16]
+
+    def generateRidesForDay(self, day, rng=None):
+        """
+        Have a person iterate over their activities to generate potential rides for one day.
+        :param rng: random.Random to sample with (default: the stream of day, cfr. rngFor)
+        """
+        rng = rng if rng is not None else self.rngFor(day)
+        visits = list()
         for activity in self.activities:
             # for every activiy, check whether it occurs
-            if not activity.sampleOccurence():
+            if not activity.sampleOccurence(rng):
                 continue
 
-            arrive = activity.sampleStartTime(day)
-            destination = activity.sampleLocation()
+            arrive = activity.sampleStartTime(day, rng)
+            destination = activity.sampleLocation(rng)
 
+            # Check if return ride needs to be made. If not, person will not go home in between activities for example.
+            duration = None if activity.sampleBridge(rng) else activity.sampleDuration(rng)
+            visits.append((arrive, destination, duration))
+
+        return self.ridesForVisits(visits)
+
+    def ridesForVisits(self, visits):
+        """
+        The rides to make a day of visits (cfr. generateRidesForDay, batchGeneration).
+        :param visits: list of (arrival time, location, duration of the stay or None if not returning home after), in order of activities
+        """
+        rides = list()
+
+        # current location (starts from home every day)
+        origin = self.home
+
+        # ride back, if any
+        returnRide = None
+        for arrive, destination, duration in visits:
             # check if possible, given return ride
+            ride = None
             if returnRide is not None:
                 ride = Ride(self, returnRide.destination, destination, arrive, self.passengers)
                 if ride.departBy < returnRide.arriveBy:
-                    pass    # cancel return ride, leave from previous location
+                    ride = None     # cancel return ride, leave from previous location
                 else:
-                    # return ride valid, add it
+                    # return ride valid, add it. The ride to check leaves from home, so it is the actual ride.
                     rides.append(returnRide)
                     origin = returnRide.destination
                     returnRide = None
 
             # create the actual ride
-            ride = Ride(self, origin, destination, arrive, self.passengers)
+            if ride is None:
+                ride = Ride(self, origin, destination, arrive, self.passengers)
             rides.append(ride)
             origin = destination
 
             # Check if return ride needs to be made. If not, person will not go home in between activities for example.
-            if not activity.sampleBridge():
-                duration = activity.sampleDuration()
+            if duration is not None:
                 returnRide = Ride(self, origin, self.home, arrive + duration, self.passengers)
 
         if returnRide is not None:
@@ -112,10 +211,10 @@ class Person(object):
 
         return rides
 
-    def addNotificationTime(self, ride, minTimeNotification):
+    def addNotificationTime(self, ride, minTimeNotification, rng=random):
         """ Sample a random notification time for a ride uniform within the possible window. """
         # Note: could add behaviour to this as well
-        ride.notificationTime = random.uniform(minTimeNotification, ride.lastPossibleNotificationTime - timedelta(minutes=5))
+        ride.notificationTime = rng.uniform(minTimeNotification, ride.lastPossibleNotificationTime - timedelta(minutes=5))
 
 
 class WorkerPerson(Person):
@@ -128,6 +227,7 @@ class WorkerPerson(Person):
 
         self.activities.append(workActivity)
         self.activities.append(hobbyActivity)
+        self.cacheDistances()
 
     @property
     def work(self):
@@ -137,6 +237,10 @@ class WorkerPerson(Person):
     def hobbies(self):
         return self.hobbyActivity.locations
 
+    @property
+    def locations(self):
+        return [self.home, self.work, *self.hobbies]
+
     def labelLocation(self, location):
         if location == self.work:
             return "Work"
@@ -165,19 +269,19 @@ class Activity(object):
         self.bridgeChanceDistribution = bridgeChanceDistribution    # chance to connect to next activity (or not return home if no next activity)
         self.locations = locations
 
-    def sampleOccurence(self):
-        return self.chanceDistribution.sample()
+    def sampleOccurence(self, rng=random):
+        return self.chanceDistribution.sample(rng)
 
-    def sampleBridge(self):
-        return self.bridgeChanceDistribution.sample()
+    def sampleBridge(self, rng=random):
+        return self.bridgeChanceDistribution.sample(rng)
 
-    def sampleStartTime(self, day):
-        return self.startDistribution.sample(day)
+    def sampleStartTime(self, day, rng=random):
+        return self.startDistribution.sample(day, rng)
 
-    def sampleDuration(self):
-        return self.durationDistribution.sample()
+    def sampleDuration(self, rng=random):
+        return self.durationDistribution.sample(rng)
 
-    def sampleLocation(self):
-        return random.choice(self.locations)
+    def sampleLocation(self, rng=random):
+        return rng.choice(self.locations)
 
 
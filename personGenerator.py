@@ -3,7 +3,7 @@ import logging
 from datetime import date, time, timedelta
 
 from distribution import BernoulliDistribution, NormalDurationDistribution, NormalTimeDistribution
-from settings import WORK_DISTANCE_SCALE, HOBBY_DISTANCE_SCALE, MAX_ATTEMPTS
+from settings import WORK_DISTANCE_SCALE, HOBBY_DISTANCE_SCALE, MAX_HOBBIES, MAX_ATTEMPTS
 from person import WorkerPerson, Activity
 import geometry
 
@@ -37,11 +37,25 @@ class WorkerPersonGenerator(object):
     def sampleHobbyBridgeChance(self):
         return BernoulliDistribution(randomChance(0.2, 0.2))
 
-    def generate(self, firstname, lastname, username, gender, password, home, detourTolerance):
-        work = geometry.sampleLocationNear(home, WORK_DISTANCE_SCALE)
-        workActivity = Activity(self.sampleWorkStartTime(), self.sampleWorkDuration(), self.sampleWorkChance(), self.sampleWorkBridgeChance(), [work])
+    def sampleLocations(self, homes):
+        """
+        Sample work and hobby locations for a batch of homes at once.
+        Returns a list with a tuple (work, hobbyLocations) for every home.
+        """
+        works = geometry.sampleLocationsNear(homes, WORK_DISTANCE_SCALE, 1)
+        hobbies = geometry.sampleLocationsNear(homes, HOBBY_DISTANCE_SCALE, MAX_HOBBIES)
+        return [
+            (geometry.toTuples(work)[0], geometry.toTuples(hobbyLocations[:random.randint(1, MAX_HOBBIES)]))
+            for work, hobbyLocations in zip(works, hobbies)
+        ]
+
+    def generate(self, firstname, lastname, username, gender, password, home, detourTolerance, locations=None):
+        """ Generate a WorkerPerson. Locations (work, hobbyLocations) are sampled around home if not given. """
+        if locations is None:
+            locations = self.sampleLocations([home])[0]
+        work, hobbyLocations = locations
 
-        hobbyLocations = [geometry.sampleLocationNear(home, HOBBY_DISTANCE_SCALE) for _ in range(random.randint(1, 8))]
+        workActivity = Activity(self.sampleWorkStartTime(), self.sampleWorkDuration(), self.sampleWorkChance(), self.sampleWorkBridgeChance(), [work])
         hobbyActivity = Activity(self.sampleHobbyStartTime(), self.sampleHobbyDuration(), self.sampleHobbyChance(), self.sampleHobbyBridgeChance(), hobbyLocations)
 
         return WorkerPerson(firstname, lastname, username, gender, password, home, detourTolerance, workActivity, hobbyActivity)
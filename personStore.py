@@ -0,0 +1,148 @@
+import os
+import pickle
+import sqlite3
+import logging
+import threading
+
+from person import Person
+
+
+class PersonStore(object):
+    """
+    Single file store for people, replacing the directory with one pickle file per person.
+    Backed by an sqlite table with one row per person, keyed by username. Loading everyone is a single query,
+    instead of opening every file of the directory.
+    """
+    def __init__(self, path, timeout=60):
+        """
+        :param path: file of the store, created if it doesn't exist yet
+        :param timeout: seconds to wait for a lock when another process (e.g. a generator worker) is writing
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        with self.connection:
+            # revision increases with every write, so readers can tell which people changed since they last loaded
+            self.connection.execute("CREATE TABLE IF NOT EXISTS people (username TEXT PRIMARY KEY, revision INTEGER NOT NULL DEFAULT 0, data BLOB NOT NULL)")
+            columns = [column[1] for column in self.connection.execute("PRAGMA table_info(people)")]
+            if "revision" not in columns:
+                self.connection.execute("ALTER TABLE people ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM people").fetchone()[0]
+
+    def __contains__(self, username):
+        return self.connection.execute("SELECT 1 FROM people WHERE username = ?", (username,)).fetchone() is not None
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, person):
+        """ Add or overwrite a single person. """
+        self.addAll([person])
+
+    def addAll(self, people):
+        """ Add or overwrite people in bulk, within a single transaction. """
+        rows = [(person.username, pickle.dumps(person, pickle.HIGHEST_PROTOCOL)) for person in people]
+        with self.connection:
+            # take the write lock immediately, so concurrent writers can't hand out the same revision
+            self.connection.execute("BEGIN IMMEDIATE")
+            revision = self.connection.execute("SELECT COALESCE(MAX(revision), 0) + 1 FROM people").fetchone()[0]
+            self.connection.executemany("INSERT OR REPLACE INTO people (username, revision, data) VALUES (?, ?, ?)",
+                                        [(username, revision, data) for username, data in rows])
+
+    def remove(self, username):
+        with self.connection:
+            self.connection.execute("DELETE FROM people WHERE username = ?", (username,))
+
+    def usernames(self):
+        return [username for username, in self.connection.execute("SELECT username FROM people")]
+
+    def manifest(self):
+        """ Maps the username of every person in the store to the revision in which it was last written. """
+        return dict(self.connection.execute("SELECT username, revision FROM people"))
+
+    def load(self, username):
+        """ Load a single person by username. Returns None if there is no such person. """
+        row = self.connection.execute("SELECT data FROM people WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def loadMany(self, usernames):
+        """ Load the people with the given usernames. Unknown usernames are ignored. """
+        people = list()
+        usernames = list(usernames)
+        # stay below the maximum amount of parameters of sqlite
+        for i in range(0, len(usernames), 500):
+            chunk = usernames[i:i + 500]
+            query = f"SELECT data FROM people WHERE username IN ({', '.join('?' * len(chunk))})"
+            people.extend(pickle.loads(data) for data, in self.connection.execute(query, chunk))
+        return people
+
+    def loadAll(self):
+        """ Load all people in the store. """
+        return [pickle.loads(data) for data, in self.connection.execute("SELECT data FROM people")]
+
+    def migrateFrom(self, directory, removeFiles=True):
+        """
+        Move all people pickled in directory (one file per person, the old format) into the store.
+        Files are only removed once the people are committed to the store.
+        Returns the amount of people migrated.
+        """
+        files = Person.listFiles(directory)
+        if not files:
+            return 0
+
+        people = [Person.loadFrom(file) for file in files]
+        self.addAll(people)
+        logging.info(f"Migrated {len(people)} people from {directory} to {self.path}")
+
+        if removeFiles:
+            for file in files:
+                os.remove(file)
+        return len(people)
+
+
+def fingerprint(path, directory):
+    """
+    Cheap summary of the store at path and the directory it is in: modification time and size.
+    If the fingerprint didn't change, neither did the people (new files in the directory are detected as well).
+    """
+    try:
+        stat = os.stat(path)
+        directoryStat = os.stat(directory)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, directoryStat.st_mtime_ns
+
+
+class PersonStoreWatcher(threading.Thread):
+    """
+    Polls the store file (and directory for people still saved as separate files) and calls callback when either changed.
+    Allows picking up new people without waiting for the next daily update.
+    """
+    def __init__(self, path, directory, interval, callback):
+        super().__init__(name="PersonStoreWatcher", daemon=True)
+        self.path = path
+        self.directory = directory
+        self.interval = interval
+        self.callback = callback
+        self.stopped = threading.Event()
+
+    def run(self):
+        last = fingerprint(self.path, self.directory)
+        while not self.stopped.wait(self.interval):
+            current = fingerprint(self.path, self.directory)
+            if current != last:
+                logging.info("Change in people detected")
+                last = current
+                self.callback()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+from distances import KM_PER_DEGREE
+
+
+# Where people live, roughly: the largest Belgian municipalities with their approximate location and amount of
+# inhabitants (rounded, around 2020). This is no census data, only an approximation that is good enough to make people
+# live (and rides happen) where they do in reality: in and around cities, and along the axes between them.
+CITIES = [
+    # name, lat, lon, inhabitants
+    ("Brussels", 50.8467, 4.3525, 1220000),
+    ("Antwerp", 51.2194, 4.4025, 530000),
+    ("Ghent", 51.0543, 3.7174, 263000),
+    ("Charleroi", 50.4108, 4.4446, 202000),
+    ("Liège", 50.6326, 5.5797, 197000),
+    ("Bruges", 51.2093, 3.2247, 118000),
+    ("Namur", 50.4674, 4.8720, 111000),
+    ("Leuven", 50.8798, 4.7005, 102000),
+    ("Mons", 50.4542, 3.9523, 95000),
+    ("Mechelen", 51.0259, 4.4776, 87000),
+    ("Aalst", 50.9378, 4.0403, 86000),
+    ("La Louvière", 50.4797, 4.1872, 80000),
+    ("Hasselt", 50.9307, 5.3325, 78000),
+    ("Sint-Niklaas", 51.1650, 4.1436, 78000),
+    ("Kortrijk", 50.8282, 3.2649, 77000),
+    ("Ostend", 51.2154, 2.9286, 71000),
+    ("Tournai", 50.6056, 3.3878, 69000),
+    ("Genk", 50.9650, 5.5000, 66000),
+    ("Seraing", 50.5833, 5.5000, 64000),
+    ("Roeselare", 50.9469, 3.1227, 63000),
+    ("Mouscron", 50.7436, 3.2139, 58000),
+    ("Verviers", 50.5891, 5.8623, 55000),
+    ("Beveren", 51.2120, 4.2560, 48000),
+    ("Dendermonde", 51.0286, 4.1010, 46000),
+    ("Beringen", 51.0489, 5.2267, 46000),
+    ("Turnhout", 51.3227, 4.9447, 45000),
+    ("Vilvoorde", 50.9281, 4.4245, 44000),
+    ("Dilbeek", 50.8480, 4.2598, 43000),
+    ("Heist-op-den-Berg", 51.0756, 4.7277, 43000),
+    ("Lokeren", 51.1036, 3.9937, 41000),
+    ("Sint-Truiden", 50.8166, 5.1866, 40000),
+    ("Herstal", 50.6667, 5.6333, 40000),
+    ("Geel", 51.1621, 4.9900, 40000),
+    ("Halle", 50.7339, 4.2345, 40000),
+    ("Braine-l'Alleud", 50.6839, 4.3680, 40000),
+    ("Ninove", 50.8284, 4.0245, 39000),
+    ("Brasschaat", 51.2911, 4.4917, 38000),
+    ("Waregem", 50.8890, 3.4270, 38000),
+    ("Maasmechelen", 50.9650, 5.6940, 38000),
+    ("Lier", 51.1313, 4.5700, 36000),
+    ("Mol", 51.1916, 5.1164, 36000),
+    ("Châtelet", 50.4041, 4.5255, 36000),
+    ("Ypres", 50.8514, 2.8857, 35000),
+    ("Wavre", 50.7167, 4.6000, 34000),
+    ("Tienen", 50.8073, 4.9378, 34000),
+    ("Lommel", 51.2304, 5.3133, 34000),
+    ("Knokke-Heist", 51.3500, 3.2667, 33000),
+    ("Tongeren", 50.7806, 5.4645, 31000),
+    ("Ottignies-Louvain-la-Neuve", 50.6667, 4.5667, 31000),
+    ("Arlon", 49.6833, 5.8167, 30000),
+    ("Nivelles", 50.5976, 4.3287, 28000),
+    ("Eupen", 50.6283, 6.0356, 19000),
+    ("Marche-en-Famenne", 50.2270, 5.3440, 17000),
+    ("Bastogne", 50.0000, 5.7167, 16000),
+    ("Dinant", 50.2606, 4.9122, 13000),
+]
+INHABITANTS = 11500000      # of Belgium, the ones that don't live in CITIES are spread evenly over the country
+AREA = 30689                # km², of Belgium
+
+
+def citySpread(inhabitants):
+    """ Standard deviation in km of the inhabitants of a city around its centre: larger cities sprawl further. """
+    return 1 + 1.5 * math.sqrt(inhabitants / 100000)
+
+
+def density(lats, lons):
+    """
+    Vectorized approximate population density (inhabitants per km²) at coordinates in Belgium: a normal distribution
+    around every city of CITIES, on top of an even spread of the rest of the inhabitants.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    result = np.full(lats.shape, (INHABITANTS - sum(city[3] for city in CITIES)) / AREA)
+    for _, lat, lon, inhabitants in CITIES:
+        spread = citySpread(inhabitants)
+        y = (lats - lat) * KM_PER_DEGREE
+        x = (lons - lon) * KM_PER_DEGREE * math.cos(math.radians(lat))
+        result += inhabitants / (2 * math.pi * spread ** 2) * np.exp(-(x * x + y * y) / (2 * spread ** 2))
+    return result
@@ -1,12 +1,12 @@
-from datetime import timedelta
-from collections import defaultdict
+import random
+from datetime import date, timedelta
 from cached_property import cached_property
 
-from geopy.distance import distance
-
-from util import daterange
-from settings import SPEED, MINIMUM_TRAVEL_MARGIN
+from util import daterange, toEpoch, fromEpoch
+from settings import SPEED, MINIMUM_TRAVEL_MARGIN, DETOUR_MARGIN
+from distances import distance, fastDistance
 import sender
+import batchGeneration
 
 
 class BaseRide(object):
@@ -24,7 +24,7 @@ class BaseRide(object):
 
     @cached_property
     def distance(self):
-        return distance(self.origin, self.destination).km
+        return distance(self.origin, self.destination)
 
     @cached_property
     def travelTime(self):
@@ -47,6 +47,13 @@ class QuerryRide(BaseRide):
 class Simulatable(object):
     def __init__(self):
         self.notificationTime = None
+        self.uid = None             # stable id of the ride, unique for the simulation
+        self.stateId = None         # key in persistent state, set once stored
+
+    @property
+    def username(self):
+        """ Username of the person that gets notified. """
+        return self.person.username
 
     def notify(self, simulator):
         return True
@@ -68,6 +75,23 @@ class Ride(BaseRide, Simulatable):
         self.passengerPlaces = passengerPlaces
         self.rideId = rideId
 
+    @cached_property
+    def distance(self):
+        """ Taken from the cached distances of the person if possible, people of other teams are only known by id. """
+        if hasattr(self.person, "distanceBetween"):
+            known = self.person.distanceBetween(self.origin, self.destination)
+            if known is not None:
+                return known
+        return distance(self.origin, self.destination)
+
+    @cached_property
+    def travelTime(self):
+        if hasattr(self.person, "travelTimeBetween"):
+            known = self.person.travelTimeBetween(self.origin, self.destination)
+            if known is not None:
+                return known
+        return timedelta(seconds=self.distance / SPEED)
+
     def __str__(self):
         origin, destination = self.origin, self.destination
         if hasattr(self.person, "labelLocation"):
@@ -81,13 +105,20 @@ class Ride(BaseRide, Simulatable):
         Sends ride to webservice. Returns True if successful, False otherwise.
         First tries to join an existing ride, if none found, creates new ride.
         """
-        # join ride
+        # join ride: the candidates of the webservice, completed with the open rides the simulator created itself
         candidates = sender.searchRide(self, simulator)
-
-        # select candidate
-        for candidate in candidates:
-            if candidate.passengerPlaces == 0:
+        known = {candidate.rideId for candidate in candidates}
+        candidates.extend(candidate for _, _, candidate in simulator.openRides.search(self.origin, self.destination, self.arriveBy)
+                          if candidate.rideId not in known)
+        ownId = simulator.findPersonId(self.person)
+
+        # select candidate, least detour first
+        for detour, candidate in rankByDetour(self, candidates):
+            if candidate.passengerPlaces == 0 or (ownId is not None and driverIdOf(candidate, simulator) == ownId):
                 continue
+            if detour > self.person.detourTolerance * DETOUR_MARGIN:
+                # candidates are ranked, the others need an even larger detour
+                break
 
             rideRequest = RideRequest(self, candidate)
             # check if passenger wants to join and whether notification time would still be possible given current time of simulator)
@@ -95,22 +126,48 @@ class Ride(BaseRide, Simulatable):
                 # a good candidate is found, try to join
                 status = sender.sendRideRequest(rideRequest, simulator)
                 if status:
-                    # If it's one of our rides, schedule a rideRequest, so it can be accepted or declined by the driver
-                    driver = simulator.findPerson(rideRequest.rideToJoin.person)
+                    # If it's one of our rides, schedule a rideRequest, so it can be accepted or declined by the driver.
+                    # Candidates can be shared (cfr. Simulator.openRides), so the request gets its own ride to join.
+                    driver = simulator.findPerson(candidate.person)
                     if driver:
-                        rideRequest.rideToJoin.person = driver
-                        simulator.scheduleRide(rideRequest)
+                        rideRequest.rideToJoin = Ride(driver, candidate.origin, candidate.destination, candidate.arriveBy,
+                                                      candidate.passengerPlaces, rideId=candidate.rideId)
+                        simulator.addRide(rideRequest)
                     return True
 
                 # if join did not work, stop trying and make own ride
                 break
 
-        return sender.sendRide(self, simulator)
+        status = sender.sendRide(self, simulator)
+        if status:
+            simulator.rideCreated(self)
+        return status
 
     def rescheduleNotificationTime(self, minTime):
         self.person.addNotificationTime(self, minTime)
 
 
+def driverIdOf(candidate, simulator):
+    """ userId of the driver of a candidate ride, which refers to them by userId or, for our own rides, as Person. """
+    if hasattr(candidate.person, "username"):
+        return simulator.findPersonId(candidate.person)
+    return candidate.person
+
+
+def rankByDetour(ride, candidates):
+    """
+    Estimate the detour factor (cfr. RideRequest.detourFactor) of joining each candidate with ride, using fast distances
+    regardless of DISTANCE_MODE. Returns a list of (estimated detour factor, candidate), least detour first.
+    """
+    ranked = list()
+    for candidate in candidates:
+        direct = fastDistance(candidate.origin, candidate.destination)
+        withDetour = fastDistance(candidate.origin, ride.origin) + fastDistance(ride.origin, ride.destination) + fastDistance(ride.destination, candidate.destination)
+        ranked.append((withDetour / direct if direct > 0 else float("inf"), candidate))
+    ranked.sort(key=lambda rank: rank[0])
+    return ranked
+
+
 class RideRequest(BaseRide, Simulatable):
     """ A ride join request to another ride. """
 
@@ -119,12 +176,13 @@ class RideRequest(BaseRide, Simulatable):
         Simulatable.__init__(self)
         self.ride = ride                # the ride the person desires (BaseRide)
         self.rideToJoin = rideToJoin    # the ride to join (Ride)
+        self.uid = f"{ride.uid}>{rideToJoin.rideId}"
 
     @cached_property
     def distance(self):
-        return distance(self.rideToJoin.origin, self.ride.origin).km \
+        return distance(self.rideToJoin.origin, self.ride.origin) \
                + self.ride.distance\
-               + distance(self.ride.destination, self.rideToJoin.destination).km
+               + distance(self.ride.destination, self.rideToJoin.destination)
 
     @cached_property
     def detourFactor(self):
@@ -140,6 +198,11 @@ class RideRequest(BaseRide, Simulatable):
         """ Does the driver want to do this """
         return self.detourFactor <= self.rideToJoin.person.detourTolerance
 
+    @property
+    def person(self):
+        """ The person that gets notified, i.e. the driver. """
+        return self.rideToJoin.person
+
     def notify(self, simulator):
         status = self.driverOk
         return sender.notifyRideRequest(self, status, simulator)
@@ -152,6 +215,152 @@ class RideRequest(BaseRide, Simulatable):
         return self.ride.lastPossibleNotificationTime
 
 
+class RideRecord(object):
+    """
+    Compact form of a Ride while it is scheduled or persisted: the person by username, coordinates as floats and times
+    as whole seconds since the epoch, in slots instead of a dict with cached values and a reference to the person.
+    Rides are only expanded into a Ride (cfr. expand) to be notified, or when their person picks a new notification time.
+    """
+    __slots__ = ("username", "originLat", "originLon", "destinationLat", "destinationLon", "arriveAt", "notifyAt",
+                 "lastNotifyAt", "passengerPlaces", "uid", "generated", "stateId")
+
+    def __init__(self, username, originLat, originLon, destinationLat, destinationLon, arriveAt, notifyAt, lastNotifyAt, passengerPlaces, uid,
+                 generated=None):
+        self.username = username
+        self.originLat = originLat
+        self.originLon = originLon
+        self.destinationLat = destinationLat
+        self.destinationLon = destinationLon
+        self.arriveAt = arriveAt            # arriveBy, in seconds since the epoch
+        self.notifyAt = notifyAt            # notificationTime, in seconds since the epoch
+        self.lastNotifyAt = lastNotifyAt    # lastPossibleNotificationTime, in seconds since the epoch
+        self.passengerPlaces = passengerPlaces
+        self.uid = uid
+        self.generated = generated          # if the ride can be generated again (cfr. PersonRides.generateRecords): generatedAt, in seconds since the epoch
+        self.stateId = None                 # key in persistent state, set once stored
+
+    @classmethod
+    def fromRide(cls, ride, generatedAt=None):
+        return cls(ride.person.username, float(ride.origin[0]), float(ride.origin[1]), float(ride.destination[0]), float(ride.destination[1]),
+                   toEpoch(ride.arriveBy), toEpoch(ride.notificationTime), toEpoch(ride.lastPossibleNotificationTime), ride.passengerPlaces, ride.uid,
+                   toEpoch(generatedAt) if generatedAt is not None else None)
+
+    def __reduce__(self):
+        # pickled as the arguments of __init__ only, the stateId is the key it is persisted under
+        return RideRecord, (self.username, self.originLat, self.originLon, self.destinationLat, self.destinationLon, self.arriveAt,
+                            self.notifyAt, self.lastNotifyAt, self.passengerPlaces, self.uid, self.generated)
+
+    def __str__(self):
+        return f"[{self.username}]: {self.origin} -> {self.destination} by {self.arriveBy.isoformat(' ', 'minutes')}, notify at {self.notificationTime.isoformat(' ', 'minutes')}"
+
+    @property
+    def origin(self):
+        return self.originLat, self.originLon
+
+    @property
+    def destination(self):
+        return self.destinationLat, self.destinationLon
+
+    @property
+    def arriveBy(self):
+        return fromEpoch(self.arriveAt)
+
+    @property
+    def notificationTime(self):
+        return fromEpoch(self.notifyAt)
+
+    @notificationTime.setter
+    def notificationTime(self, time):
+        self.notifyAt = toEpoch(time)
+
+    @property
+    def lastPossibleNotificationTime(self):
+        return fromEpoch(self.lastNotifyAt)
+
+    @property
+    def generatedAt(self):
+        return fromEpoch(self.generated) if self.generated is not None else None
+
+    def expand(self, person):
+        """ The Ride of person this is a record of, e.g. to send it to the webservice (cfr. sender). """
+        ride = Ride(person, self.origin, self.destination, self.arriveBy, self.passengerPlaces)
+        ride.notificationTime = self.notificationTime
+        ride.uid = self.uid
+        ride.stateId = self.stateId
+        return ride
+
+    def notify(self, simulator):
+        return self.expand(simulator.people[self.username]).notify(simulator)
+
+
+def notificationKey(ride):
+    """ Order of rides by notification time, the uid breaks ties (cfr. PersonRides.upcoming). """
+    return ride.notificationTime, ride.uid
+
+
+def compact(ride):
+    """ The RideRecord of a Ride, other kinds of rides (e.g. ride requests) and records are returned as is. """
+    return RideRecord.fromRide(ride) if type(ride) is Ride else ride
+
+
+class RideSet(object):
+    """
+    Ordered collection of rides, indexed by uid and by day (of arriveBy).
+    Adding and removing are O(1), rides of a day (or range of days) can be found without scanning all rides.
+    """
+    def __init__(self, rides=()):
+        self.rides = dict()     # maps uid -> ride, in order of insertion
+        self.days = dict()      # maps day -> dict of uid -> ride
+        for ride in rides:
+            self.add(ride)
+
+    def __len__(self):
+        return len(self.rides)
+
+    def __iter__(self):
+        return iter(list(self.rides.values()))
+
+    def __contains__(self, ride):
+        return ride.uid in self.rides
+
+    def get(self, uid):
+        return self.rides.get(uid)
+
+    def add(self, ride):
+        assert ride.uid is not None, "Rides need a uid to be indexed."
+        self.rides[ride.uid] = ride
+        self.days.setdefault(ride.arriveBy.date(), dict())[ride.uid] = ride
+
+    def remove(self, ride):
+        """ Remove ride (by uid). Raises KeyError if not present. """
+        del self.rides[ride.uid]
+        day = ride.arriveBy.date()
+        rides = self.days[day]
+        del rides[ride.uid]
+        if not rides:
+            del self.days[day]
+
+    def onDay(self, day):
+        """ Rides that arrive on day. """
+        return list(self.days.get(day, dict()).values())
+
+    def between(self, startDay, endDay):
+        """ Rides that arrive in [startDay, endDay[, ordered by day. """
+        return [ride for day in sorted(self.days) if startDay <= day < endDay for ride in self.days[day].values()]
+
+    def pruneBefore(self, time):
+        """ Remove all rides that arrive before time. Returns the removed rides. """
+        pruned = list()
+        for day in sorted(self.days):
+            if day > time.date():
+                break
+            pruned.extend(ride for ride in self.days[day].values() if ride.arriveBy < time)
+
+        for ride in pruned:
+            self.remove(ride)
+        return pruned
+
+
 class PersonRides(object):
     """
     Collection of rides of a person with some utility functions.
@@ -159,39 +368,103 @@ class PersonRides(object):
     """
     def __init__(self, person):
         self.person = person
-        self.rides = list()
+        self.rides = RideSet()
         self.lastGeneratedDay = None
 
+    def withPerson(self, person):
+        """ PersonRides of a changed version of the person, that shares the rides and the generation progress. """
+        personRides = PersonRides(person)
+        personRides.rides = self.rides
+        personRides.lastGeneratedDay = self.lastGeneratedDay
+        return personRides
+
+    def addRide(self, ride):
+        """ Add a ride, rides without uid (e.g. from older state) get one. """
+        if getattr(ride, "uid", None) is None:
+            day = ride.arriveBy.date()
+            index = len(self.rides.onDay(day))
+            while self.rides.get(self.rideUid(day, index)) is not None:
+                index += 1
+            ride.uid = self.rideUid(day, index)
+        self.rides.add(ride)
+
     def removeRide(self, ride):
         self.rides.remove(ride)
 
+    def upcoming(self, after=None):
+        """
+        Generator of the rides of this person in order of notification time (cfr. notificationKey), only those after the
+        key after if given. Rides that are removed while iterating are skipped, rides that are added are not yielded.
+        """
+        for ride in sorted(self.rides, key=notificationKey):
+            if (after is None or notificationKey(ride) > after) and ride in self.rides:
+                yield ride
+
+    def rideUid(self, day, index):
+        """ Uid of the index-th ride of this person on day. """
+        return f"{self.person.username}:{day.isoformat()}:{index}"
+
+    @staticmethod
+    def dayOf(uid):
+        """ The day a ride was generated for, from its uid (cfr. rideUid). Can differ from the day it arrives. """
+        return date.fromisoformat(uid.rsplit(":", 2)[1])
+
     def generateUntil(self, endDay, minStartTime=None):
-        """ Generate rides for all days from max(minStartDay, lastGeneratedDay) until endDay. """
+        """
+        Generate rides for all days from max(minStartDay, lastGeneratedDay) until endDay.
+        Returns the records (cfr. RideRecord) of the newly generated rides, they are kept once added (cfr. addRide).
+        """
+        days = self.daysUntil(endDay, minStartTime)
+        records = list()
+        for day, dayRecords in zip(days, batchGeneration.generateDays([(self, day, minStartTime) for day in days])):
+            records.extend(dayRecords)
+            self.lastGeneratedDay = day
+        return records
+
+    def daysUntil(self, endDay, minStartTime=None):
+        """ The days that still need to be generated to reach endDay: from max(minStartDay, lastGeneratedDay + 1). """
         assert not (self.lastGeneratedDay is None and minStartTime is None), "Need some starting point."
         if self.lastGeneratedDay is None:
             startDay = minStartTime.date()
         else:
             startDay = max(minStartTime.date(), self.lastGeneratedDay + timedelta(1))
+        return list(daterange(startDay, endDay))
 
-        for day in daterange(startDay, endDay):
-            self.generateDay(day, minStartTime)
-            self.lastGeneratedDay = day
+    def generateRecords(self, day, generatedAt):
+        """
+        Records of the rides of day, generated at generatedAt. If the person is reproducible, the records remember
+        generatedAt: calling this again with the same day and time gives the same rides, so they don't need to be persisted
+        (cfr. StateStore). People that can be generated in batch are (cfr. batchGeneration.generateDays).
+        """
+        if self.person.batchable:
+            return batchGeneration.generateDays([(self, day, generatedAt)])[0]
+        if not self.person.reproducible:
+            return [RideRecord.fromRide(ride) for ride in self.generateDay(day, generatedAt)]
+        # records keep whole seconds, so the rides are generated from a time that is stored exactly
+        generatedAt = generatedAt.replace(microsecond=0)
+        return [RideRecord.fromRide(ride, generatedAt) for ride in self.generateDay(day, generatedAt)]
 
     def generateDay(self, day, minTimeNotification):
         # print(f"Generating day: {day}")
-        rides = self.person.generateRidesForDay(day)
-        for ride in rides:
-            self.person.addNotificationTime(ride, minTimeNotification)
+        rng = self.person.rngFor(day)
+        return self.addDay(day, self.person.generateRidesForDay(day, rng), minTimeNotification, rng)
 
-        self.rides.extend(rides)
+    def addDay(self, day, rides, minTimeNotification, rng=random):
+        """
+        Give the rides generated for day a notification time and uid. Returns the rides.
+        :param rng: random.Random to sample notification times with, e.g. the stream of day (cfr. Person.rngFor)
+        """
+        for index, ride in enumerate(rides):
+            if minTimeNotification is not None:
+                self.person.addNotificationTime(ride, minTimeNotification, rng)
+            ride.uid = self.rideUid(day, index)
+
+        return rides
 
     def ridesToStr(self):
         ret = ""
-        days = defaultdict(list)
-        for ride in self.rides:
-            days[ride.arriveBy.date()].append(ride)
-
-        for day, rides in days.items():
+        for day in sorted(self.rides.days):
+            rides = self.rides.onDay(day)
             ret += f"{day}\n"
             for ride in rides:
                 ret += f"\t{str(ride)}\n"
@@ -0,0 +1,121 @@
+import math
+import threading
+
+from settings import SEARCH_RADIUS, SEARCH_WINDOW
+from distances import fastDistance, KM_PER_DEGREE
+from util import EPOCH
+
+
+class RideIndex(object):
+    """
+    Spatio-temporal index of open rides: a grid over origin and destination, combined with buckets of arrival time.
+    Searching rides near an origin, destination and arrival time only visits the neighbouring cells and buckets,
+    so it doesn't slow down with the amount of rides elsewhere or at other times. Thread safe.
+    """
+    def __init__(self, radius=SEARCH_RADIUS, window=SEARCH_WINDOW, latitude=50.5):
+        """
+        :param radius: km, default max distance between origins (and destinations) of a search and the rides found, also the size of cells
+        :param window: timedelta, default max difference in arrival time of a search and the rides found, also the size of buckets
+        :param latitude: cells are about square around this latitude (default: Belgium), elsewhere they are still correct
+        """
+        self.radius = radius
+        self.window = window
+        self.latStep = radius / KM_PER_DEGREE                               # degrees
+        self.lonStep = self.latStep / math.cos(math.radians(latitude))      # degrees
+        self.bucketSize = window.total_seconds()
+
+        self.lock = threading.Lock()
+        self.cells = dict()         # maps (origin cell, destination cell, bucket) -> dict of key -> entry
+        self.entries = dict()       # maps key -> (origin, destination, arriveBy, item, cell key)
+        self.buckets = dict()       # maps bucket -> set of keys, to prune by time
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def cell(self, point):
+        return math.floor(point[0] / self.latStep), math.floor(point[1] / self.lonStep)
+
+    def bucket(self, time):
+        return math.floor((time - EPOCH).total_seconds() / self.bucketSize)
+
+    def add(self, key, origin, destination, arriveBy, item):
+        """ Index item (e.g. a ride) under key. An item that is already indexed under key is replaced. """
+        cellKey = (self.cell(origin), self.cell(destination), self.bucket(arriveBy))
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (origin, destination, arriveBy, item, cellKey)
+            self.cells.setdefault(cellKey, dict())[key] = self.entries[key]
+            self.buckets.setdefault(cellKey[2], set()).add(key)
+
+    def remove(self, key):
+        """ Remove the item indexed under key, if any. """
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        cellKey = entry[4]
+        cell = self.cells[cellKey]
+        del cell[key]
+        if not cell:
+            del self.cells[cellKey]
+        keys = self.buckets[cellKey[2]]
+        keys.discard(key)
+        if not keys:
+            del self.buckets[cellKey[2]]
+
+    def pruneBefore(self, time):
+        """ Remove all items that arrive before time, they can't be joined anymore. """
+        with self.lock:
+            last = self.bucket(time)
+            for bucket in [bucket for bucket in self.buckets if bucket <= last]:
+                for key in list(self.buckets.get(bucket, ())):
+                    if self.entries[key][2] < time:
+                        self._remove(key)
+
+    def neighbours(self, point, radius):
+        """ Cells that can contain points within radius of point. """
+        latCell, lonCell = self.cell(point)
+        latSpan = math.ceil(radius / KM_PER_DEGREE / self.latStep)
+        # a degree of longitude is shortest on the side closest to a pole
+        maxLatitude = min(89.0, abs(point[0]) + radius / KM_PER_DEGREE)
+        lonSpan = math.ceil(radius / (KM_PER_DEGREE * math.cos(math.radians(maxLatitude))) / self.lonStep)
+        return [(latCell + i, lonCell + j) for i in range(-latSpan, latSpan + 1) for j in range(-lonSpan, lonSpan + 1)]
+
+    def search(self, origin, destination, arriveBy, radius=None, window=None, limit=None):
+        """
+        Items with origin and destination within radius of the given ones that arrive within window of arriveBy.
+        Returns a list of (originDistance, destinationDistance, item), closest (sum of both distances) first.
+        """
+        radius = self.radius if radius is None else radius
+        window = self.window if window is None else window
+
+        origins = self.neighbours(origin, radius)
+        destinations = self.neighbours(destination, radius)
+        buckets = range(self.bucket(arriveBy - window), self.bucket(arriveBy + window) + 1)
+
+        found = list()
+        with self.lock:
+            for originCell in origins:
+                for destinationCell in destinations:
+                    for bucket in buckets:
+                        cell = self.cells.get((originCell, destinationCell, bucket))
+                        if cell:
+                            found.extend(cell.values())
+
+        results = list()
+        for itemOrigin, itemDestination, itemArriveBy, item, _ in found:
+            if abs(itemArriveBy - arriveBy) > window:
+                continue
+            originDistance = fastDistance(origin, itemOrigin)
+            destinationDistance = fastDistance(destination, itemDestination)
+            if originDistance <= radius and destinationDistance <= radius:
+                results.append((originDistance, destinationDistance, item))
+
+        results.sort(key=lambda result: result[0] + result[1])
+        return results[:limit] if limit is not None else results
@@ -2,12 +2,13 @@
 
 if [ $# -lt 2 ]
   then
-    echo "Supply team name (e.g.: team1) and amount of people to generate"
+    echo "Supply team name (e.g.: team1) and amount of people to generate (optionally followed by amount of worker processes)"
     exit 1
 fi
 
 TEAM=$1
 AMOUNT_USERS=$2
+WORKERS=${3:-1}
 
 echo "Running generator for team: $TEAM"
 
@@ -20,7 +21,7 @@ mkdir -p "$USER_DIR"
 
 . env/bin/activate
 
-python3 generator.py generatePeople "$USER_DIR" --amount "$AMOUNT_USERS"
+python3 generator.py generatePeople "$USER_DIR" --amount "$AMOUNT_USERS" --workers "$WORKERS"
 
 
 
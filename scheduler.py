@@ -0,0 +1,96 @@
+import heapq
+import itertools
+
+
+def rideKey(ride):
+    return ride.uid
+
+
+class Scheduler(object):
+    """
+    Schedule of rides, ordered by notification time.
+    A binary heap with an index from ride to its entry, so rides can be cancelled or rescheduled without rebuilding the heap.
+    Cancelled entries stay in the heap and are dropped once they reach the head.
+    Unlike queue.PriorityQueue this takes no locks: the simulator serializes access itself.
+    """
+    def __init__(self, key=None):
+        """ :param key: function that gives the unique key of a scheduled item (default: uid of ride) """
+        self.heap = list()              # entries [time, sequence, ride], ride is None when cancelled
+        self.entries = dict()           # maps key (ride uid) -> entry
+        self.sequence = itertools.count()   # tie breaker, so rides themselves never need to be compared
+        self.key = key if key is not None else rideKey
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __bool__(self):
+        return len(self.entries) > 0
+
+    def __contains__(self, ride):
+        return self.key(ride) in self.entries
+
+    def __iter__(self):
+        """ Iterate over scheduled rides, in no particular order. """
+        return (entry[2] for entry in self.entries.values())
+
+    def push(self, ride, time=None):
+        """ Schedule a ride at time (default: its notification time). A ride that is already scheduled is rescheduled. """
+        if time is None:
+            time = ride.notificationTime
+        self.cancel(ride)
+        entry = [time, next(self.sequence), ride]
+        self.entries[self.key(ride)] = entry
+        heapq.heappush(self.heap, entry)
+
+    def reschedule(self, ride, time=None):
+        self.push(ride, time)
+
+    def merge(self, rides):
+        """ Schedule many rides at once. Cheaper than pushing one by one when many rides are added. """
+        rides = list(rides)
+        if len(rides) < len(self.heap) // 8:
+            for ride in rides:
+                self.push(ride)
+            return
+
+        for ride in rides:
+            self.cancel(ride)
+            entry = [ride.notificationTime, next(self.sequence), ride]
+            self.entries[self.key(ride)] = entry
+            self.heap.append(entry)
+        self.compact()
+
+    def cancel(self, ride):
+        """ Remove ride from the schedule. Returns whether it was scheduled. """
+        entry = self.entries.pop(self.key(ride), None)
+        if entry is None:
+            return False
+        entry[2] = None
+        return True
+
+    def compact(self):
+        """ Drop all cancelled entries and restore the heap. """
+        self.heap = [entry for entry in self.heap if entry[2] is not None]
+        heapq.heapify(self.heap)
+
+    def peek(self):
+        """ Returns (time, ride) of the next ride without removing it, or None if nothing is scheduled. """
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        time, _, ride = self.heap[0]
+        return time, ride
+
+    def pop(self):
+        """ Removes and returns (time, ride) of the next ride. Raises IndexError if nothing is scheduled. """
+        while self.heap:
+            time, _, ride = heapq.heappop(self.heap)
+            if ride is not None:
+                del self.entries[self.key(ride)]
+                return time, ride
+        raise IndexError("pop from empty schedule")
+
+    def clear(self):
+        self.heap = list()
+        self.entries = dict()
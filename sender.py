@@ -3,12 +3,38 @@ from urllib.parse import urljoin
 from datetime import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from settings import LOGIN_PATH, REGISTER_PATH, DRIVES_PATH, SEARCH_PATH, PASSENGER_REQUEST_PATH, REQUEST_STATUS_PATH
+from settings import HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF
 import ride
 
 
-def sendGETRequest(url, data=None, token=None):
+def createSession(poolSize=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+    """
+    Creates a session that keeps connections to the webservice alive, so not every request sets up a new connection.
+    Failed connections are retried with exponential backoff. Error statuses are only retried for idempotent requests
+    (e.g. GET), so a ride is never created twice. Reads that time out are never retried, so a server that hangs blocks
+    a request for at most the read timeout.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def sendGETRequest(url, data=None, token=None, session=None):
     """ Wrapper for sending a GET request. """
     if data is None:
         data = dict()
@@ -21,7 +47,7 @@ def sendGETRequest(url, data=None, token=None):
         logging.debug(f"and headers: {headers}")
 
     try:
-        response = requests.get(url, data, headers=headers)
+        response = (session if session is not None else requests).get(url, params=data, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
         if response:
             logging.debug(f"Response: {response.json()}")
         return response
@@ -29,7 +55,7 @@ def sendGETRequest(url, data=None, token=None):
         logging.exception("Failed request")
 
 
-def sendPOSTRequest(url, data=None, token=None):
+def sendPOSTRequest(url, data=None, token=None, session=None):
     """ Wrapper for sending a POST request. """
     if data is None:
         data = dict()
@@ -42,7 +68,7 @@ def sendPOSTRequest(url, data=None, token=None):
         logging.debug(f"and headers: {headers}")
 
     try:
-        response = requests.post(url, json=data, headers=headers)
+        response = (session if session is not None else requests).post(url, json=data, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
         if response:
             logging.debug(f"Response: {response.json()}")
         return response
@@ -60,13 +86,14 @@ def register(person, simulator):
         "password": person.password,
         **person.getAdditionalData()
     }
-    response = sendPOSTRequest(registerUrl, data)
+    response = sendPOSTRequest(registerUrl, data, session=simulator.session)
     if response:
         try:
             id = response.json().get('id')
             simulator.registerPerson(person, id)
         except ValueError:
             logging.exception("Failed to extract id after register")
+        simulator.tokens.setRegistered(person.username)
         return True
 
     logging.debug(f"Failed to register. Response: {response}")
@@ -80,7 +107,7 @@ def login(person, simulator):
         "username": person.username,
         "password": person.password
     }
-    response = sendPOSTRequest(loginUrl, data)
+    response = sendPOSTRequest(loginUrl, data, session=simulator.session)
     if response:
         try:
             return response.json().get("token")
@@ -92,24 +119,56 @@ def login(person, simulator):
 
 
 def getToken(person, simulator):
-    """ Tries to get a login token for a person. If login fails, tries register with login. """
-    token = login(person, simulator)
-    if token is None:
-        status = register(person, simulator)
-        if not status:
-            return None
+    """
+    Tries to get a login token for a person. A cached token is used as long as it is valid.
+    People that are not known to be registered are registered first. If login fails for a registered person,
+    the webservice may have lost them (e.g. database reset), so they are registered again.
+    """
+    tokens = simulator.tokens
+    token = tokens.get(person.username, simulator.time)
+    if token is not None:
+        return token
+
+    if not tokens.isRegistered(person.username):
+        # If this fails, the person is probably registered already, login will tell
+        register(person, simulator)
+        token = login(person, simulator)
+    else:
         token = login(person, simulator)
+        if token is None:
+            tokens.setRegistered(person.username, False)
+            status = register(person, simulator)
+            if not status:
+                return None
+            token = login(person, simulator)
+
+    if token is not None:
+        tokens.set(person.username, token, simulator.time)
     return token
 
 
-def sendRide(ride, simulator):
-    """ Sends a user ride to the webservice. """
-    token = getToken(ride.person, simulator)
+def sendAuthorizedPOSTRequest(person, url, data, simulator):
+    """
+    Sends a POST request as person, with their login token. If the token is rejected (e.g. the webservice was reset), it
+    is refreshed and the request is sent once more. Returns the response, or None if there is no token or the request failed.
+    """
+    response = None
+    for _ in range(2):
+        token = getToken(person, simulator)
+        if not token:
+            logging.warning(f"No valid token for person: {person}")
+            return None
+
+        response = sendPOSTRequest(url, data, token, session=simulator.session)
+        if response is None or response.status_code != 401:
+            break
+        logging.debug(f"Token of {person} rejected, refreshing")
+        simulator.tokens.invalidate(person.username)
+    return response
 
-    if not token:
-        logging.warning(f"No valid token for person: {ride.person}")
-        return False
 
+def sendRide(ride, simulator):
+    """ Sends a user ride to the webservice. If the token is rejected, it is refreshed and the ride is sent again. """
     driveUrl = urljoin(simulator.url, DRIVES_PATH)
     data = {
         "from": ride.origin,
@@ -118,8 +177,12 @@ def sendRide(ride, simulator):
         "arrive-by": ride.arriveBy.isoformat()
     }
 
-    response = sendPOSTRequest(driveUrl, data, token)
+    response = sendAuthorizedPOSTRequest(ride.person, driveUrl, data, simulator)
     if response:
+        try:
+            ride.rideId = response.json().get("id")
+        except ValueError:
+            logging.exception("Failed to extract id of created ride")
         return True
 
     logging.debug(f"Failed to create ride. Response: {response}")
@@ -137,7 +200,7 @@ def searchRide(queryRide, simulator):
         'limit': 5,
     }
 
-    response = sendGETRequest(searchUrl, data)
+    response = sendGETRequest(searchUrl, data, session=simulator.session)
     if not response:
         return []
 
@@ -163,11 +226,11 @@ def searchRide(queryRide, simulator):
 
 
 def sendRideRequest(rideRequest, simulator):
-    """ Try to join an existing ride. """
-    rideId = rideRequest.rideToJoin.rideId
-    url = urljoin(simulator.url, REQUEST_STATUS_PATH.format(rideId))
-    response = sendPOSTRequest(url)
+    """ Try to join an existing ride, as the passenger of rideRequest. A rejected token is refreshed, cfr. sendRide. """
+    passenger = rideRequest.ride.person
+    url = urljoin(simulator.url, PASSENGER_REQUEST_PATH.format(drive_id=rideRequest.rideToJoin.rideId))
 
+    response = sendAuthorizedPOSTRequest(passenger, url, None, simulator)
     if response:
         # could check response status as well
         return True
@@ -176,19 +239,19 @@ def sendRideRequest(rideRequest, simulator):
 
 
 def notifyRideRequest(rideRequest, accept: bool, simulator):
-    """ Respond to ride request with given status. """
+    """ Respond to ride request with given status, as the driver of the ride to join. A rejected token is refreshed, cfr. sendRide. """
+    driver = rideRequest.person
     rideId = rideRequest.rideToJoin.rideId
     userId = simulator.findPersonId(rideRequest.ride.person)
-    url = urljoin(simulator.url, REQUEST_STATUS_PATH.format(rideId, userId))
+    url = urljoin(simulator.url, REQUEST_STATUS_PATH.format(drive_id=rideId, user_id=userId))
 
     data = {
         'action': "accept" if accept else "reject"
     }
 
-    response = sendPOSTRequest(url, data)
+    response = sendAuthorizedPOSTRequest(driver, url, data, simulator)
     if response:
         # could check response status as well
         return True
 
     return False
-
@@ -1,26 +1,54 @@
 import datetime
 
 # simulation settings
-DATA_FILE = "state"
+DATA_FILE = "state"                                     # shelve file of older versions, migrated to STATE_FILE
+STATE_FILE = "state.sqlite"                             # persistent state of simulation
+REPLAY_STATE_FILE = "replay.sqlite"                      # persistent state of replays, kept apart from STATE_FILE
 PEOPLE_DIR = "users"
+PEOPLE_STORE = "people.db"                              # file within PEOPLE_DIR that stores all people
 EPSILON_NOTIFICATION = datetime.timedelta(minutes=1)    # margin for notification (later than this time -> reschedule
 MAX_SLEEP_TIME = datetime.timedelta(hours=1)            # don't sleep for longer stretches than this
 RETRY_DELAY = datetime.timedelta(minutes=5)             # if missed notification or error, reschedule after this delay
 GENERATE_DAYS = datetime.timedelta(days=7)              # generate this many days into the future
+BATCH_GENERATION = True                                 # generate the rides of a chunk of people at once instead of person by person (cfr. batchGeneration.generateAll), the rides are the same
+BACKGROUND_UPDATES = True                               # reload people and generate rides in a background thread, while rides are notified
+GENERATION_CHUNK = 100                                  # people to generate rides for at a time, handed to the schedule as soon as they're done
+LAZY_SCHEDULE = True                                    # only schedule the next ride of every person and those within SCHEDULE_LOOKAHEAD, pull in more as they're notified
+SCHEDULE_LOOKAHEAD = datetime.timedelta(minutes=15)     # with LAZY_SCHEDULE, rides of a person that notify this soon are scheduled together
 
 
 # generation settings
 MINIMUM_TRAVEL_MARGIN = 1.2                             # factor to multiply travel time with
+DETOUR_MARGIN = 1.01                                    # fast estimates of detours are within this factor of the exact ones
+DISTANCE_MODE = "fast"                                  # "exact" (geodesic) or "fast" (within 0.2% over Belgium), cfr. distances.py
 SPEED = 50.0/3600                                       # speed in km/s
 WORK_DISTANCE_SCALE = 1                                 # modifier for how far work can be from home
 HOBBY_DISTANCE_SCALE = 0.8                              # modifier for how far hobbies can be from home
+MAX_HOBBIES = 8                                         # maximum amount of hobby locations per person
 MAX_ATTEMPTS = 50                                       # max retries to prevent infinite while loop
+LAND_MASK_FILE = "belgium.npz"                          # shape and land mask of Belgium next to geometry.py, built once (cfr. geometry.LandMask)
+LAND_MASK_RESOLUTION = 0.005                            # degrees, size of the cells of the land mask
+POPULATION_WEIGHTED = True                              # people live (and work) where people live in reality (cfr. population.py), not uniformly
+POPULATION_RESOLUTION = 0.02                            # degrees, size of the cells of the population grid
+NEAR_CANDIDATES = 8                                     # candidates of which a work or hobby location is picked, weighted by population
 
 
 # webservice settings
+HTTP_POOL_SIZE = 10                                     # connections kept alive to the webservice
+HTTP_CONNECT_TIMEOUT = 5                                # seconds to wait for a connection
+HTTP_READ_TIMEOUT = 30                                  # seconds to wait for a response, not retried: a hanging server blocks a request this long at most
+HTTP_RETRIES = 3                                        # retries of failed requests (cfr. sender.createSession)
+HTTP_BACKOFF = 0.5                                      # backoff factor between retries (0.5s, 1s, 2s, ...)
+TOKEN_LIFETIME = datetime.timedelta(hours=12)           # reuse login token this long (refreshed earlier if rejected)
+PERSIST_TOKENS = True                                   # keep tokens in the state, so they survive a restart
 LOGIN_PATH = "users/auth"
 REGISTER_PATH = "users/register"
 DRIVES_PATH = "drives"
 SEARCH_PATH = "drives/search"
-PASSENGER_REQUEST_PATH = "drives/{drive-id}/passenger-requests"
-REQUEST_STATUS_PATH = "/drives/{drive_id}/passenger-requests/{user_id}"
+PASSENGER_REQUEST_PATH = "drives/{drive_id}/passenger-requests"
+REQUEST_STATUS_PATH = "drives/{drive_id}/passenger-requests/{user_id}"
+
+
+# search settings (mock webservice and local index of open rides)
+SEARCH_RADIUS = 5.0                                     # km, max distance between origins (and destinations) of a search and the rides found
+SEARCH_WINDOW = datetime.timedelta(minutes=30)          # max difference in arrival time between a search and the rides found
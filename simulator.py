@@ -1,237 +1,803 @@
-import shelve
-import time
+import os
+import queue
 import logging
+import threading
 from os import path
-from queue import PriorityQueue
+from contextlib import contextmanager, ExitStack
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 from datetime import date, datetime, timedelta
 
 import bacli
 
-from person import Person
-from ride import PersonRides
-
-from settings import MAX_SLEEP_TIME, PEOPLE_DIR, EPSILON_NOTIFICATION, RETRY_DELAY, DATA_FILE, GENERATE_DAYS
-
-
-def generateRides(people, endDay):
+import sender
+from personStore import PersonStore, PersonStoreWatcher, fingerprint
+from stateStore import StateStore
+from scheduler import Scheduler
+from userIdIndex import UserIdIndex
+from tokenCache import TokenCache
+from clock import Clock, VirtualClock
+from rideIndex import RideIndex
+from ride import Ride, RideRecord, RideRequest, notificationKey
+import batchGeneration
+from stats import SimulationStats
+from mockServer import MockServer
+
+from settings import MAX_SLEEP_TIME, PEOPLE_DIR, PEOPLE_STORE, EPSILON_NOTIFICATION, RETRY_DELAY, DATA_FILE, STATE_FILE, GENERATE_DAYS
+from settings import TOKEN_LIFETIME, PERSIST_TOKENS, HTTP_POOL_SIZE, REPLAY_STATE_FILE, BATCH_GENERATION, BACKGROUND_UPDATES, GENERATION_CHUNK
+from settings import LAZY_SCHEDULE, SCHEDULE_LOOKAHEAD
+
+
+def generateRides(people, endDay, state, minStartTime):
     """
      Have a set of people generate their rides until a certain date.
-    :param people: list of people
+    :param people: list of PersonRides
     :param endDay: typically determined by current day + GENERATE_DAYS
+    :param state: StateStore in which the new rides are persisted
+    :param minStartTime: current time of the simulation, no rides are notified before
+    :return: list of (PersonRides, records of its newly generated rides (cfr. RideRecord)), the records are persisted but
+             not added to the PersonRides yet
     """
-    minStartTime = datetime.now()
-    for person in people:
-        person.generateUntil(endDay, minStartTime=minStartTime)
+    if BATCH_GENERATION:
+        generated = batchGeneration.generateAll(list(people), endDay, minStartTime)
+    else:
+        generated = [(person, person.generateUntil(endDay, minStartTime=minStartTime)) for person in people]
 
+    generated = [(person, personGenerated) for person, personGenerated in generated if personGenerated]
+    for person, personGenerated in generated:
+        state.addGenerated(person, personGenerated)
+    return generated
 
-def sleep(sleeptime: timedelta):
+
+def sleep(sleeptime: timedelta, wakeup: threading.Event = None, clock: Clock = None):
     """
-    Wrapper for time.sleep with debug log.
+    Wrapper for Clock.sleep with debug log.
     :param sleeptime: timedelta to indicate amount of time to sleep for. Microseconds are stripped.
+    :param wakeup: optional event that ends the sleep early when set
+    :param clock: clock to sleep on (default: the wall clock)
     """
     if sleeptime.seconds > 0:
         sleeptime -= timedelta(microseconds=sleeptime.microseconds)
         logging.debug(f"Sleeping for: {sleeptime}")
-        time.sleep(sleeptime.seconds)
+        (clock if clock is not None else Clock()).sleep(sleeptime, wakeup)
+
+
+currentSimulator = threading.local()        # key of the simulator a thread is working for, to split logs per simulator
 
 
-def getPersonRides(person, ridesMap):
-    """ Get or create PersonRides in persistent state (ridesMap). """
-    personRides = ridesMap.get(person, PersonRides(person))
-    ridesMap[person] = personRides
-    return personRides
+class SimulatorLogFilter(logging.Filter):
+    """ Only passes log records made while working for the simulator with the given key (cfr. currentSimulator). """
+    def __init__(self, simulatorKey):
+        super().__init__()
+        self.simulatorKey = simulatorKey
+
+    def filter(self, record):
+        return getattr(currentSimulator, "key", None) == self.simulatorKey
 
 
 class Simulator(object):
-    def __init__(self, directory: str, url: str):
+    def __init__(self, directory: str, url: str, session=None, concurrency=1, clock=None, stateFile=STATE_FILE,
+                 backgroundUpdates=BACKGROUND_UPDATES, lazySchedule=LAZY_SCHEDULE, onWakeup=None):
+        """
+        :param session: requests session to use, e.g. shared by several simulators (default: a new one)
+        :param concurrency: max amount of rides notified at the same time. 1 notifies rides one by one.
+        :param clock: source of time, e.g. a VirtualClock to replay traffic (default: the wall clock)
+        :param stateFile: file within directory for the persistent state, replays keep theirs apart from the real state
+        :param backgroundUpdates: reload people and generate rides in a background thread, while rides are notified (cfr. step)
+        :param lazySchedule: only schedule the next rides of every person, the rest is pulled in as they're notified (cfr. pullRides)
+        :param onWakeup: optionally called when the simulator should take a step before its next wake time, e.g. by a SimulationHost
+        """
         self.directory = directory
         self.url = url
-
-        self.userIdMap = dict()                 # maps userIds -> usernames
+        self.clock = clock if clock is not None else Clock()
+        self.stateFile = stateFile
+        self.name = path.basename(path.normpath(directory))
+        self.key = path.normpath(path.abspath(directory))     # unlike the name, unique for every directory
+        self.concurrency = concurrency
+        if session is None:
+            session = sender.createSession(poolSize=max(HTTP_POOL_SIZE, concurrency))
+        self.session = session                  # pooled connections to webservice
+        self.notifier = None                    # pool of threads that notify rides, while running with concurrency > 1
+        self.lock = threading.RLock()           # guards the state notifying threads can change (schedule, user ids)
+        self.updateRequired = True              # update (reload people, generate rides) on next step
+        self.lastGeneratedDay = None
+        self.backgroundUpdates = backgroundUpdates
+        self.updater = None                     # thread that runs updates in the background, while running with backgroundUpdates
+        self.update = None                      # future of the update that is running in the background, if any
+        self.handOffs = queue.SimpleQueue()     # changes made by an update, to be applied by step (cfr. handOff)
+
+        self.userIds = UserIdIndex()            # maps userIds <-> usernames
+        self.tokens = TokenCache(TOKEN_LIFETIME)    # login tokens of people
         self.people = dict()                    # maps usernames -> users
-        self.schedule = PriorityQueue()
+        self.ridesMap = dict()                  # maps usernames -> PersonRides
+        self.schedule = Scheduler()
+        self.lazySchedule = lazySchedule
+        self.pulled = dict()                    # with lazySchedule, maps usernames -> key of the last ride pulled into the schedule (cfr. notificationKey)
+        self.openRides = RideIndex()            # rides created on the webservice that didn't arrive yet, to find rides to join
+        self.state = None                       # StateStore, opened while simulating
+        self.stats = SimulationStats()          # what happened to rides and how late they were notified
+
+        self.peopleManifest = dict()            # maps usernames -> revision in store of the loaded users
+        self.peopleFingerprint = None           # fingerprint of store at last load, to skip reloads if nothing changed
+        self.peopleChanged = threading.Event()  # set by watcher to trigger a reload
+        self.wakeup = threading.Event()         # set when a step should be taken early: people changed or an update handed off changes
+        self.onWakeup = onWakeup
 
     @property
     def data_path(self):
+        """ Path of the shelve file used by older versions, only used for migration. """
         return path.join(self.directory, DATA_FILE)
 
+    @property
+    def state_path(self):
+        return path.join(self.directory, self.stateFile)
+
     @property
     def people_path(self):
         return path.join(self.directory, PEOPLE_DIR)
 
+    @property
+    def people_store_path(self):
+        return path.join(self.people_path, PEOPLE_STORE)
+
     @property
     def time(self):
-        return datetime.now()
+        return self.clock.now()
 
     def findPerson(self, personId):
-        username = self.userIdMap.get(personId)
+        username = self.userIds.getUsername(personId)
         if username:
             return self.people.get(username)
         return None
 
     def findPersonId(self, person):
-        for userId, username in self.userIdMap.items():
-            if username == person.username:
-                return userId
+        return self.userIds.getUserId(person.username)
 
-        return None
+    def rideCreated(self, ride):
+        """ Remember a ride that was created on the webservice, so it can be found as candidate to join (cfr. Ride.notify). """
+        driverId = self.findPersonId(ride.person)
+        if ride.rideId is None or driverId is None:
+            return
+        # like the candidates of a search, the driver is given by userId
+        candidate = Ride(driverId, ride.origin, ride.destination, ride.arriveBy, ride.passengerPlaces, rideId=ride.rideId)
+        self.openRides.add(ride.rideId, ride.origin, ride.destination, ride.arriveBy, candidate)
 
     def registerPerson(self, person, personId):
-        if personId in self.userIdMap:
-            logging.error(f"Someone already in user map with id {personId}, overwriting")
-        self.userIdMap[personId] = person.username
+        """ Store the userId the webservice gave to person. Returns False if the userId was already given to someone else. """
+        with self.lock:
+            unique = self.userIds.register(personId, person.username)
+            if self.state is not None:
+                self.state.setUserId(personId, person.username)
+            return unique
+
+    @contextmanager
+    def running(self):
+        """
+        Context in which the simulator can take steps: opens the persistent state and the pool of notifiers.
+        """
+        with ExitStack() as stack:
+            state = stack.enter_context(StateStore(self.state_path))
+            if self.concurrency > 1:
+                self.notifier = stack.enter_context(ThreadPoolExecutor(self.concurrency))
 
-    def simulate(self):
+            if self.stateFile == STATE_FILE:
+                state.migrateFrom(self.data_path)
+            self.state = state
+            self.userIds = UserIdIndex(state.loadUserIds())
+            self.tokens = TokenCache(TOKEN_LIFETIME, state if PERSIST_TOKENS else None)
+
+            # The last generated day
+            self.lastGeneratedDay = state.get("lastGeneratedDay")
+            self.updateRequired = True
+            self.handOffs = queue.SimpleQueue()
+            if self.backgroundUpdates:
+                self.updater = ThreadPoolExecutor(1, thread_name_prefix=f"{self.name}-update")
+            try:
+                yield self
+            finally:
+                if self.updater is not None:
+                    # an update that is still running needs the state, changes it didn't hand off yet are persisted already
+                    self.updater.shutdown()
+                self.updater = None
+                self.update = None
+                self.state = None
+                self.notifier = None
+
+    def wake(self):
+        """ Have the simulator take a step as soon as possible. """
+        self.wakeup.set()
+        if self.onWakeup is not None:
+            self.onWakeup()
+
+    def handOff(self, function, *args):
+        """ Have step apply a change of an update, so the live state is only ever changed by the thread that notifies rides. """
+        self.handOffs.put((function, args))
+        self.wake()
+
+    def applyHandOffs(self):
+        """ Apply the changes updates handed off so far, in order. """
+        while True:
+            try:
+                function, args = self.handOffs.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                function(*args)
+
+    def step(self):
+        """
+        One iteration of the simulation: update if required and handle the rides that need to be notified.
+        Needs to run within the running context. Returns the time at which the next step should be taken.
+        """
+        currentSimulator.key = self.key
+        self.wakeup.clear()
+
+        # Take over what the update in the background did so far, once it is done it decides the last generated day
+        if self.update is not None and self.update.done():
+            update, self.update = self.update, None
+            self.applyHandOffs()
+            self.finishUpdate(update.result)
+        self.applyHandOffs()
+
+        # Check if update is required, a change during an update requires another one
+        generateUntil = self.clock.today() + GENERATE_DAYS
+        # print("Generate until: ", generateUntil)
+        if self.update is None and (self.lastGeneratedDay is None or self.lastGeneratedDay < generateUntil):
+            self.updateRequired = True
+
+        # Check if watcher noticed a change in people
+        if self.update is None and self.peopleChanged.is_set():
+            self.peopleChanged.clear()
+            self.updateRequired = True
+
+        # Generate rides and update users, in the background rides keep being notified meanwhile
+        if self.updateRequired and self.update is None:
+            logging.info("Performing update")
+            self.updateRequired = False
+            if self.updater is not None:
+                self.update = self.updater.submit(self.updateAll, generateUntil)
+                self.update.add_done_callback(lambda _: self.wake())
+            else:
+                self.finishUpdate(lambda: self.updateAll(generateUntil))
+                self.applyHandOffs()
+
+        # Simulate rides by taking the rides to be notified, if any
+        if self.schedule:
+            self.checkDueRides()
+
+        # Wake up when next ride needs to be notified, but don't sleep for longer stretches than MAX_SLEEP_TIME
+        now = self.time
+        if not self.schedule:
+            return now + MAX_SLEEP_TIME
+        notificationTime, nextRide = self.schedule.peek()
+        return max(now, min(now + MAX_SLEEP_TIME, notificationTime))
+
+    def finishUpdate(self, result):
+        """ Take the last generated day from the result of an update (function that returns it, or raises what went wrong). """
+        try:
+            self.lastGeneratedDay = result()
+        except Exception:
+            self.updateRequired = True
+            raise
+
+    def simulate(self, until=None):
         """
         Main loop of the simulation. Loads the persistent state of rides from file and creates a priority queue based on
         the notifications times. People generate rides up to GENERATE_DAYS in the future, which are send to the webservice
         on their notification time.
-        :param directory: data directory for the simulation. Should contain a users/ dir with users and a state file will be created
-        :param url: base url of the webservice
+        :param until: optional time (of the clock) at which to stop, e.g. the end of a replay
         """
-        with shelve.open(self.data_path, writeback=True) as state:
-            # Maps Person to PersonRides
-            ridesMap = state.setdefault("ridesMap", dict())
-            self.userIdMap = state.setdefault("userIdMap", dict())
-
-            # The last generated day
-            lastGeneratedDay = state.get("lastGeneratedDay", None)
+        with self.running():
+            while until is None or self.time < until:
+                wakeTime = self.step()
+                if until is not None:
+                    wakeTime = min(wakeTime, until)
+                sleep(max(timedelta(seconds=0), wakeTime - self.time), self.wakeup, self.clock)
+
+    def watchPeople(self, interval, callback=None):
+        """
+        Start a watcher that triggers a reload of people as soon as the store changes, polling every interval seconds.
+        :param callback: optionally called as well on change, e.g. to wake up a SimulationHost
+        """
+        def onChange():
+            self.peopleChanged.set()
+            self.wake()
+            if callback is not None:
+                callback()
 
-            update = True
-            while True:
-                # Check if update is required
-                generateUntil = date.today() + GENERATE_DAYS
-                # print("Generate until: ", generateUntil)
-                if lastGeneratedDay is None or lastGeneratedDay < generateUntil:
-                    update = True
-
-                # Generate rides and update users
-                if update:
-                    logging.info("Performing update")
-                    state.sync()
-                    self.updateAll(generateUntil, state)
-                    lastGeneratedDay = state["lastGeneratedDay"]
-                    update = False
-
-                # Simulate rides by taking next ride to be notified, if any
-                if not self.schedule.empty():
-                    self.checkNextRide(state)
-
-                # Check if there is a next ride
-                if self.schedule.empty():
-                    sleep(MAX_SLEEP_TIME)
-                    continue
-
-                # Sleep until next ride needs to be notified
-                notificationTime, nextRide = self.schedule.queue[0]
-                sleeptime = max(timedelta(seconds=0), min(MAX_SLEEP_TIME, (notificationTime - datetime.now())))
-                sleep(sleeptime)
+        watcher = PersonStoreWatcher(self.people_store_path, self.people_path, interval, onChange)
+        watcher.start()
+        return watcher
 
     def scheduleRide(self, ride):
-        """ Add a ride to the schedule. Schedule is a priority queue based on notification time. """
-        self.schedule.put((ride.notificationTime, ride))
+        """ Add a ride to the schedule (or move it if it's already scheduled). Schedule is based on notification time. """
+        self.schedule.push(ride)
 
-    def removeRide(self, ride, state):
-        """ Remove a ride from the persistent state. """
-        # logging.debug(f"Removing ride: {ride}")
-        ridesMap = state["ridesMap"]
-        personRides = ridesMap[ride.person]
-        personRides.removeRide(ride)
+    def pullRides(self, username):
+        """
+        With lazySchedule, the schedule holds the upcoming rides of a person (cfr. PersonRides.upcoming) up to the first
+        one after SCHEDULE_LOOKAHEAD: the rides that notify after it are only pulled in once it is notified (or it is
+        within the lookahead). Schedule the next rides of a person if that's the case now.
+        """
+        personRides = self.ridesMap.get(username)
+        if personRides is None:
+            return
+        horizon = self.time + SCHEDULE_LOOKAHEAD
+        last = self.pulled.get(username)
+        if last is not None and last[0] > horizon:
+            lastRide = personRides.rides.get(last[1])
+            if lastRide is not None and lastRide in self.schedule:
+                return
+        for ride in personRides.upcoming(last):
+            self.scheduleRide(ride)
+            self.pulled[username] = notificationKey(ride)
+            if ride.notificationTime > horizon:
+                break
+
+    def addRide(self, ride):
+        """ Add a new ride (e.g. a ride request for one of our drivers) to the persistent state and schedule it. """
+        with self.lock:
+            if ride.notificationTime is None:
+                ride.rescheduleNotificationTime(self.time)
+            self.ridesMap[ride.username].addRide(ride)
+            self.state.addRide(ride)
+            self.scheduleRide(ride)
+
+    def rescheduleNotificationTime(self, ride):
+        """ Have the person of a ride pick a new notification time from now on, records are expanded for it (cfr. RideRecord). """
+        if isinstance(ride, RideRecord):
+            expanded = ride.expand(self.people[ride.username])
+            expanded.rescheduleNotificationTime(self.time)
+            ride.notificationTime = expanded.notificationTime
+        else:
+            ride.rescheduleNotificationTime(self.time)
 
-    def updateAll(self, generateUntil, state):
-        """ Reload people, generate rides and update schedule """
-        # Load people from files in folder
-        self.people = {p.username: p for p in Person.loadAllFrom(self.people_path)}
+    def removeRide(self, ride):
+        """ Remove a ride from the schedule and the persistent state. """
+        # logging.debug(f"Removing ride: {ride}")
+        self.schedule.cancel(ride)
+        personRides = self.ridesMap.get(ride.username)
+        if personRides is not None:
+            personRides.removeRide(ride)
+        self.state.removeRide(ride)
 
-        # Find associated PersonRides info or create if it doesn't exist yet
-        ridesMap = state["ridesMap"]
-        peopleRides = [getPersonRides(person, ridesMap) for person in self.people.values()]
+    def reloadPeople(self):
+        """
+        Incrementally reload people from the store. People that are still saved as separate files are migrated first.
+        Only people that were added or changed since the last reload are loaded, removed people are evicted together with their rides.
+        Runs as part of an update, possibly in the background: new collections of people and their rides are prepared
+        aside and swapped in at once (cfr. swapPeople). Returns the PersonRides of all people after the reload.
+        """
+        with PersonStore(self.people_store_path) as store:
+            store.migrateFrom(self.people_path)
+
+            current = fingerprint(self.people_store_path, self.people_path)
+            if current is not None and current == self.peopleFingerprint:
+                logging.debug("People unchanged, skipping reload")
+                return list(self.ridesMap.values())
+
+            manifest = store.manifest()
+            changed = [username for username, revision in manifest.items() if self.peopleManifest.get(username) != revision]
+            loaded = {person.username: person for person in store.loadMany(changed)}
+
+        people = dict(self.people)
+        people.update(loaded)
+        ridesMap = dict(self.ridesMap)
+
+        # changed people keep their rides (and progress), but these should refer to the new person
+        changedRides = list()
+        for username, person in loaded.items():
+            personRides = ridesMap.get(username)
+            if personRides is not None:
+                changedRides.append(personRides.withPerson(person))
+                ridesMap[username] = changedRides[-1]
+
+        # restore the persistent state of new people
+        added = [username for username in loaded if username not in ridesMap]
+        addedRides = self.state.loadPersonRides(added, people)
+        ridesMap.update(addedRides)
+
+        removed = [username for username in people if username not in manifest]
+        removedRides = list()
+        for username in removed:
+            del people[username]
+            if username in ridesMap:
+                removedRides.append(ridesMap.pop(username))
+
+        # people in the persistent state can also have been removed while the simulator wasn't running
+        for username in self.state.usernames():
+            if username not in manifest:
+                self.state.removePerson(username)
+
+        self.handOff(self.swapPeople, people, ridesMap, changedRides, list(addedRides.values()), removedRides)
+        logging.info(f"Reloaded people: {len(loaded)} added or changed, {len(removed)} removed")
+        self.peopleManifest = manifest
+        self.peopleFingerprint = current
+        return list(ridesMap.values())
+
+    def swapPeople(self, people, ridesMap, changedRides, addedRides, removedRides):
+        """ Swap in the people and their rides prepared by reloadPeople. """
+        # people that would generate other rides now can't generate their rides again, they're stored instead (cfr. StateStore)
+        for personRides in changedRides:
+            previous = self.people.get(personRides.person.username)
+            if previous is not None and previous.fingerprint != personRides.person.fingerprint:
+                self.state.storeInFull(personRides)
+        self.people = people
+        self.ridesMap = ridesMap
+        # records refer to their person by username, only ride requests hold on to the driver
+        for personRides in changedRides:
+            for ride in personRides.rides:
+                if isinstance(ride, RideRequest):
+                    ride.rideToJoin.person = personRides.person
+        for personRides in removedRides:
+            for ride in personRides.rides:
+                self.schedule.cancel(ride)
+            self.pulled.pop(personRides.person.username, None)
+        if self.lazySchedule:
+            for personRides in addedRides:
+                self.pullRides(personRides.person.username)
+        else:
+            self.schedule.merge(ride for personRides in addedRides for ride in personRides.rides)
 
-        self.userIdMap = state["userIdMap"]
+    def updateAll(self, generateUntil):
+        """
+        Reload people, generate rides and update schedule. Returns generateUntil.
+        Can run in the background (cfr. step): the live people, rides and schedule are only read, all changes are handed
+        off to step (cfr. handOff). Rides are generated for GENERATION_CHUNK people at a time and handed off right away,
+        so they are scheduled before the whole update is done.
+        """
+        currentSimulator.key = self.key
 
-        # Update all rides
-        generateRides(peopleRides, generateUntil)
-        state["lastGeneratedDay"] = generateUntil
+        # Reload people that changed in the store in the folder
+        peopleRides = self.reloadPeople()
 
-        # Schedule them
-        self.schedule = PriorityQueue()
-        for personRides in peopleRides:
-            for ride in personRides.rides:
-                self.scheduleRide(ride)
+        # Drop rides that already happened, they can't be notified or joined anymore
+        self.handOff(self.pruneBefore, self.time)
 
-    def checkNextRide(self, state):
+        # Update all rides
+        for start in range(0, len(peopleRides), GENERATION_CHUNK):
+            generated = generateRides(peopleRides[start:start + GENERATION_CHUNK], generateUntil, self.state, self.time)
+            self.handOff(self.addGenerated, generated)
+        self.state.set("lastGeneratedDay", generateUntil)
+        return generateUntil
+
+    def pruneBefore(self, time):
+        """ Drop rides that arrive before time. """
+        self.openRides.pruneBefore(time)
+        for username, personRides in self.ridesMap.items():
+            pruned = personRides.rides.pruneBefore(time)
+            for ride in pruned:
+                self.schedule.cancel(ride)
+            self.state.removeRides(pruned)
+            if pruned and self.lazySchedule:
+                self.pullRides(username)
+        # rides generated for the day before can still arrive today
+        self.state.removeDaysBefore(time.date() - timedelta(days=1))
+
+    def addGenerated(self, generated):
+        """
+        Keep and schedule generated rides (cfr. generateRides), rides that were already scheduled stay put.
+        With lazySchedule, only rides that notify before the last ride pulled of their person are scheduled right away,
+        the others are pulled in when it's their turn (cfr. pullRides).
         """
-        Handle the next ride that needs to be notified.
+        for personRides, records in generated:
+            for record in records:
+                personRides.addRide(record)
+        if not self.lazySchedule:
+            self.schedule.merge(record for _, records in generated for record in records)
+            return
+
+        early = list()
+        for personRides, records in generated:
+            last = self.pulled.get(personRides.person.username)
+            if last is not None:
+                early.extend(record for record in records if notificationKey(record) <= last)
+        self.schedule.merge(early)
+        for personRides, _ in generated:
+            self.pullRides(personRides.person.username)
+
+    def checkDueRides(self):
+        """
+        Handle all rides whose notification time has come.
         Depending on the time to be notified and the time of the ride, decide to either send, reschedule, wait or discard.
+        Rides that need to be sent are notified together (concurrently, cfr. notifyAll), after which their outcomes are
+        applied in order of notification time.
         """
-        notificationTime, nextRide = self.schedule.get()
-
-        logging.info(f"Next ride: {nextRide}")
-
-        if notificationTime <= datetime.now() + EPSILON_NOTIFICATION:
-            # notification time passed and too late to reschedule
-            if nextRide.lastPossibleNotificationTime < datetime.now():
-                # Too late to notify still -> discard
-                logging.info(f"Discarded, too late")
-                self.removeRide(nextRide, state)
-            elif datetime.now() - notificationTime < EPSILON_NOTIFICATION:
-                # Need to notify
-                # If failed, reschedule notification
-                logging.info(f"Notifying")
-                status = nextRide.notify(self)
+        toNotify = list()
+        with self.lock:
+            while self.schedule:
+                notificationTime, nextRide = self.schedule.peek()
+                if notificationTime > self.time + EPSILON_NOTIFICATION:
+                    # notification in future, it stays at the head of the schedule
+                    break
+
+                self.schedule.pop()
+                if self.lazySchedule:
+                    self.pullRides(nextRide.username)
+                logging.info(f"Next ride: {nextRide}")
+
+                # notification time passed and too late to reschedule
+                if nextRide.lastPossibleNotificationTime < self.time:
+                    # Too late to notify still -> discard
+                    logging.info(f"Discarded, too late")
+                    self.stats.count("discarded")
+                    self.removeRide(nextRide)
+                elif self.time - notificationTime < EPSILON_NOTIFICATION:
+                    # Need to notify
+                    self.stats.lag(self.time - notificationTime)
+                    toNotify.append(nextRide)
+                else:
+                    # Notification somewhere in past
+                    # Resample notification time and reschedule
+                    logging.warning(f"Missed notification for ride")
+                    logging.warning("Rescheduling notification")
+                    self.stats.count("missed")
+                    self.rescheduleNotificationTime(nextRide)
+                    self.state.updateRide(nextRide)
+                    self.scheduleRide(nextRide)
+                    logging.warning(f"Notification rescheduled to {nextRide.notificationTime}")
+
+        statuses = self.notifyAll(toNotify)
+
+        # If failed, reschedule notification
+        with self.lock:
+            for ride, status in zip(toNotify, statuses):
                 if status:
-                    logging.info("Succes!")
-                    self.removeRide(nextRide, state)
+                    logging.info(f"Succes! {ride}")
+                    self.stats.count("notified")
+                    self.removeRide(ride)
                 else:
-                    logging.info("Notify failed")
+                    logging.info(f"Notify failed: {ride}")
+                    self.stats.count("failed")
                     logging.info(f"Retrying in {RETRY_DELAY}")
-                    nextRide.notificationTime += RETRY_DELAY
-                    self.scheduleRide(nextRide)
-            else:
-                # Notification somewhere in past
-                # Resample notification time and reschedule
-                logging.warning(f"Missed notification for ride")
-                logging.warning("Rescheduling notification")
-                nextRide.rescheduleNotificationTime(datetime.now())
-                self.scheduleRide(nextRide)
-                logging.warning(f"Notification rescheduled to {notificationTime}")
-        else:
-            logging.info("Notification in future, skipping")
-            self.scheduleRide(nextRide)
+                    ride.notificationTime += RETRY_DELAY
+                    self.state.updateRide(ride)
+                    self.scheduleRide(ride)
 
         logging.info("")
 
+    def notifyAll(self, rides):
+        """
+        Notify rides and return whether each succeeded, in the order of rides.
+        With a notifier pool, rides are notified concurrently. Rides of the same person are always notified one after
+        another, so they never race for the same login or registration.
+        """
+        if self.notifier is None:
+            return self.notifySequentially(rides)
+
+        indicesPerPerson = defaultdict(list)
+        for index, ride in enumerate(rides):
+            indicesPerPerson[ride.username].append(index)
+
+        futures = {
+            username: self.notifier.submit(self.notifySequentially, [rides[index] for index in indices])
+            for username, indices in indicesPerPerson.items()
+        }
+
+        statuses = [False] * len(rides)
+        for username, indices in indicesPerPerson.items():
+            for index, status in zip(indices, futures[username].result()):
+                statuses[index] = status
+        return statuses
+
+    def notifySequentially(self, rides):
+        """ Notify rides one by one. A ride that raises an error counts as failed, so it is retried later. """
+        currentSimulator.key = self.key
+        statuses = list()
+        for ride in rides:
+            logging.info(f"Notifying {ride}")
+            try:
+                statuses.append(ride.notify(self))
+            except Exception:
+                logging.exception(f"Error while notifying {ride}")
+                statuses.append(False)
+        return statuses
+
+
+class SimulationHost(object):
+    """
+    Runs several simulators (e.g. one per team) in a single process. They share one schedule and one pool of connections,
+    while the state of every simulator stays isolated in its own directory.
+    Steps of different simulators run in parallel and every simulator notifies with a share of the concurrency of its own,
+    so one slow webservice doesn't hold up the other teams.
+    """
+    def __init__(self, teams, concurrency=1, clock=None):
+        """
+        :param teams: list of (directory, url) pairs, one for each simulator
+        :param concurrency: max amount of rides notified at the same time over all simulators, split evenly over them.
+                            Every simulator gets at least one, so this is at least the amount of simulators.
+        :param clock: source of time shared by all simulators (default: the wall clock)
+        """
+        self.clock = clock if clock is not None else Clock()
+        concurrency = max(concurrency, len(teams))
+        self.session = sender.createSession(poolSize=max(HTTP_POOL_SIZE, concurrency))
+        self.wakeup = threading.Event()
+        self.simulators = [
+            Simulator(directory, url, session=self.session, concurrency=concurrency // len(teams) + (i < concurrency % len(teams)),
+                      clock=self.clock, onWakeup=self.wakeup.set)
+            for i, (directory, url) in enumerate(teams)
+        ]
+        self.schedule = Scheduler(key=lambda simulator: simulator.directory)   # idle simulators, by time of their next step
+
+    def watchPeople(self, interval):
+        """ Watch the people of every simulator, cfr. Simulator.watchPeople. """
+        return [simulator.watchPeople(interval) for simulator in self.simulators]
+
+    def simulate(self):
+        """ Main loop: start a step for every simulator that is due, then sleep until the next one is due or a step finished. """
+        with ExitStack() as stack:
+            stepper = stack.enter_context(ThreadPoolExecutor(max(1, len(self.simulators))))
+            for simulator in self.simulators:
+                stack.enter_context(simulator.running())
+                self.schedule.push(simulator, self.clock.now())
+
+            steps = dict()      # maps futures of running steps -> simulator
+            while True:
+                self.wakeup.clear()
+
+                # reschedule simulators of which the step finished
+                for future in [future for future in steps if future.done()]:
+                    simulator = steps.pop(future)
+                    try:
+                        nextStep = future.result()
+                    except Exception:
+                        # one failing simulator shouldn't stop the others
+                        logging.exception(f"Error during step of {simulator.name}, retrying later")
+                        nextStep = self.clock.now() + RETRY_DELAY
+                    self.schedule.push(simulator, nextStep)
+
+                # simulators that noticed a change in their people or got rides from their update step right away
+                for simulator in self.simulators:
+                    if simulator.wakeup.is_set() and simulator in self.schedule:
+                        self.schedule.push(simulator, self.clock.now())
+
+                # start steps of simulators that are due
+                while self.schedule and self.schedule.peek()[0] <= self.clock.now():
+                    wakeTime, simulator = self.schedule.pop()
+                    future = stepper.submit(simulator.step)
+                    steps[future] = simulator
+                    future.add_done_callback(lambda _: self.wakeup.set())
+
+                sleeptime = MAX_SLEEP_TIME
+                if self.schedule:
+                    wakeTime, simulator = self.schedule.peek()
+                    sleeptime = max(timedelta(seconds=0), min(sleeptime, wakeTime - self.clock.now()))
+                if steps:
+                    # a virtual clock shouldn't jump ahead of the steps that are still running
+                    self.clock.wait(sleeptime, self.wakeup)
+                else:
+                    sleep(sleeptime, self.wakeup, self.clock)
+
+
+def runReplay(directory, url, startDay, days, speedup=0, concurrency=1):
+    """
+    Replay days of traffic from the beginning of startDay on a VirtualClock, cfr. the replay command.
+    The replay starts from a clean state. Returns the simulator, e.g. for its stats.
+    """
+    begin = datetime.combine(startDay, datetime.min.time())
+    end = begin + timedelta(days=days)
+
+    statePath = path.join(directory, REPLAY_STATE_FILE)
+    for suffix in ("", "-wal", "-shm"):
+        if path.exists(statePath + suffix):
+            os.remove(statePath + suffix)
+
+    clock = VirtualClock(begin, speedup)
+    # without speedup the clock jumps ahead as soon as the simulator sleeps, so it can't update in the background
+    simulator = Simulator(directory, url, concurrency=concurrency, clock=clock, stateFile=REPLAY_STATE_FILE, backgroundUpdates=speedup > 0)
+    try:
+        simulator.simulate(until=end)
+    except KeyboardInterrupt:
+        logging.info("Shutting down")
+    logging.info(f"Replayed {simulator.time - begin} of traffic: {simulator.stats}")
+    return simulator
+
+
+def readTeams(teamsFile):
+    """ Reads (directory, url) pairs from a file with a line 'directory url' per team. Empty lines and lines starting with # are skipped. """
+    teams = list()
+    with open(teamsFile) as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            directory, url = line.split()
+            teams.append((directory, url))
+    return teams
+
+
+def addLogFile(filename, logFilter=None):
+    """ Log to a rotating file, optionally only the records that pass logFilter. """
+    log = logging.getLogger()
+    log.setLevel(logging.DEBUG)  # this must be DEBUG to allow debug messages through
+
+    fileHandler = RotatingFileHandler(
+        filename,
+        mode='a',
+        maxBytes=5*1024*1024,
+        backupCount=1
+    )
+    formatter = logging.Formatter('%(asctime)s [%(levelname)s]: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    fileHandler.setFormatter(formatter)
+    fileHandler.setLevel(logging.DEBUG)
+    if logFilter is not None:
+        fileHandler.addFilter(logFilter)
+    log.addHandler(fileHandler)
+
 
 # utility module for turning functions into command line interface (cli) commands
 with bacli.cli() as cli:
 
     @cli.command
-    def run(directory: str, url: str):
-        """ Run the simulator for the specified directory and webservice. """
-        log = logging.getLogger()
-        log.setLevel(logging.DEBUG)  # this must be DEBUG to allow debug messages through
-
+    def run(directory: str, url: str, watch: int = 0, concurrency: int = 1):
+        """
+        Run the simulator for the specified directory and webservice.
+        If watch is given, the people are polled every watch seconds for changes, otherwise changes are picked up on the daily update.
+        Up to concurrency rides are notified at the same time, which keeps up with bursts of rides on a slow webservice.
+        """
         # console = logging.StreamHandler()
         # console.setLevel(logging.INFO)
         # formatter = logging.Formatter(f'[{path.basename(directory)}] [%(levelname)s]: %(message)s')
         # console.setFormatter(formatter)
         # log.addHandler(console)
 
-        fileHandler = RotatingFileHandler(
-            path.join(directory, "simulator.log"),
-            mode='a',
-            maxBytes=5*1024*1024,
-            backupCount=1
-        )
-        formatter = logging.Formatter('%(asctime)s [%(levelname)s]: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        fileHandler.setFormatter(formatter)
-        fileHandler.setLevel(logging.DEBUG)
-        log.addHandler(fileHandler)
+        addLogFile(path.join(directory, "simulator.log"))
 
-        simulator = Simulator(directory, url)
+        simulator = Simulator(directory, url, concurrency=concurrency)
+        if watch > 0:
+            simulator.watchPeople(watch)
 
         try:
             simulator.simulate()
         except KeyboardInterrupt:
             logging.info("Shutting down")
+
+    @cli.command
+    def replay(directory: str, url: str, start: str = None, days: int = 7, speedup: float = 0, concurrency: int = 1):
+        """
+        Replay days of traffic of the people in directory against the webservice at url (e.g. a local stand-in), on a virtual clock.
+        Time starts at the beginning of day start (iso date, default today) and runs speedup times as fast as real time.
+        Without speedup the simulator jumps straight to the next notification, to replay as fast as the webservice allows.
+        Replays have their own state and log, the state of run is left untouched. Every replay starts from a clean state.
+        """
+        addLogFile(path.join(directory, "replay.log"))
+        runReplay(directory, url, date.fromisoformat(start) if start else date.today(), days, speedup, concurrency)
+
+    @cli.command
+    def benchmark(directory: str, days: int = 1, speedup: float = 0, concurrency: int = 1, latency: float = 0.0, errorRate: float = 0.0):
+        """
+        Measure the simulator end to end: replay days of traffic of the people in directory (cfr. replay) against a local
+        mock webservice, of which requests take latency seconds on average and errorRate of them fail.
+        Reports the rides notified per second, the lag of notifications and the requests the webservice handled.
+        Lag is only meaningful with a speedup, without one time stands still while notifying.
+        """
+        addLogFile(path.join(directory, "benchmark.log"))
+
+        server = MockServer(latency=latency, errorRate=errorRate).start()
+        try:
+            simulator = runReplay(directory, server.url, date.today(), days, speedup, concurrency)
+        finally:
+            server.stop()
+
+        print(f"Simulator: {simulator.stats}")
+        print("Webservice:")
+        for (route, status), amount in sorted(server.counts.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+            print(f"\t{route} {status}: {amount}")
+
+    @cli.command
+    def runMany(teams: str, watch: int = 0, concurrency: int = 1):
+        """
+        Run the simulators of many teams in one process. Teams is a file with a line 'directory url' per team.
+        Every team keeps its own state and log in its directory. Watch and concurrency work as for run, concurrency is split over the teams (at least one each).
+        """
+        host = SimulationHost(readTeams(teams), concurrency=concurrency)
+        for simulator in host.simulators:
+            addLogFile(path.join(simulator.directory, "simulator.log"), SimulatorLogFilter(simulator.key))
+        if watch > 0:
+            host.watchPeople(watch)
+
+        try:
+            host.simulate()
+        except KeyboardInterrupt:
+            logging.info("Shutting down")
@@ -0,0 +1,370 @@
+import io
+import dbm
+import pickle
+import shelve
+import sqlite3
+import logging
+import functools
+import threading
+from datetime import date, datetime
+
+from person import Person
+from ride import PersonRides, compact
+import batchGeneration
+
+
+class MissingPerson(KeyError):
+    """ Raised when a persisted ride refers to a person that no longer exists. """
+    pass
+
+
+class PersonPickler(pickle.Pickler):
+    """
+    Pickles people by reference (username), so a ride doesn't drag along its whole person.
+    Most rides are records (cfr. RideRecord) that refer to their person by username anyway, ride requests still need this.
+    """
+    def persistent_id(self, obj):
+        if isinstance(obj, Person):
+            return obj.username
+        return None
+
+
+class PersonUnpickler(pickle.Unpickler):
+    """ Resolves people pickled by PersonPickler using the currently loaded people. """
+    def __init__(self, file, people):
+        super().__init__(file)
+        self.people = people
+
+    def persistent_load(self, username):
+        person = self.people.get(username)
+        if person is None:
+            raise MissingPerson(username)
+        return person
+
+
+def synchronized(method):
+    """ Decorator for methods of StateStore: only one thread uses the connection at a time. """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def dumpRide(ride):
+    buffer = io.BytesIO()
+    PersonPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(ride)
+    return buffer.getvalue()
+
+
+def loadRide(data, people):
+    return PersonUnpickler(io.BytesIO(data), people).load()
+
+
+def isGenerated(ride):
+    """ Whether a ride can be generated again from the day it was generated for, instead of being stored. """
+    return getattr(ride, "generatedAt", None) is not None
+
+
+class StateStore(object):
+    """
+    Persistent state of the simulator: pending rides, generation progress per person and the user id mapping.
+    Backed by sqlite in WAL mode, so sending, discarding or rescheduling a ride is a small point update that is committed
+    right away instead of rewriting the whole state.
+    Rides that can be generated again (cfr. PersonRides.generateRecords) aren't stored themselves: only the days they were
+    generated for and what happened to them since (sent, discarded or rescheduled) are. On load they are generated
+    again, as long as the person would still generate the same rides (cfr. Person.fingerprint). Other rides (e.g. ride
+    requests) are stored in a row per ride.
+    """
+    def __init__(self, path):
+        self.path = path
+        # rides can be notified from several threads (cfr. Simulator.notifyAll), the lock serializes use of the connection
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")     # safe in WAL mode, only the last commits can be lost on power failure
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS rides (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    notificationTime TEXT,
+                    data BLOB NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS rides_username ON rides (username);
+                CREATE TABLE IF NOT EXISTS days (
+                    username TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    generatedAt TEXT NOT NULL,
+                    fingerprint TEXT,           -- of the person that generated the day (cfr. Person.fingerprint)
+                    PRIMARY KEY (username, day)
+                );
+                CREATE TABLE IF NOT EXISTS overrides (
+                    uid TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    notificationTime TEXT       -- NULL once the ride is done (sent or discarded)
+                );
+                CREATE INDEX IF NOT EXISTS overrides_day ON overrides (day);
+                CREATE TABLE IF NOT EXISTS people (username TEXT PRIMARY KEY, lastGeneratedDay TEXT);
+                CREATE TABLE IF NOT EXISTS userIds (userId PRIMARY KEY, username TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS tokens (username TEXT PRIMARY KEY, token TEXT, expiry TEXT, registered INTEGER NOT NULL DEFAULT 0);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+            """)
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(days)")]
+            if "fingerprint" not in columns:
+                self.connection.execute("ALTER TABLE days ADD COLUMN fingerprint TEXT")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @synchronized
+    def close(self):
+        self.connection.close()
+
+    @synchronized
+    def get(self, key, default=None):
+        """ Get a global value, such as lastGeneratedDay. """
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(row[0])
+
+    @synchronized
+    def set(self, key, value):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, pickle.dumps(value)))
+
+    @synchronized
+    def loadUserIds(self):
+        """ Returns a dict that maps userIds -> usernames. """
+        return dict(self.connection.execute("SELECT userId, username FROM userIds"))
+
+    @synchronized
+    def setUserId(self, userId, username):
+        """ Map userId to username, replacing earlier mappings of either (cfr. UserIdIndex). """
+        with self.connection:
+            self.connection.execute("DELETE FROM userIds WHERE username = ?", (username,))
+            self.connection.execute("INSERT OR REPLACE INTO userIds (userId, username) VALUES (?, ?)", (userId, username))
+
+    @synchronized
+    def loadTokens(self):
+        """ Returns a dict that maps usernames -> (token, expiry) and the set of registered usernames (cfr. TokenCache). """
+        tokens = dict()
+        registered = set()
+        for username, token, expiry, isRegistered in self.connection.execute("SELECT username, token, expiry, registered FROM tokens"):
+            if token is not None:
+                tokens[username] = (token, datetime.fromisoformat(expiry))
+            if isRegistered:
+                registered.add(username)
+        return tokens, registered
+
+    @synchronized
+    def setToken(self, username, token, expiry):
+        """ Store (or with token None: clear) the token of a person. Having a token implies being registered. """
+        with self.connection:
+            if token is None:
+                self.connection.execute("UPDATE tokens SET token = NULL, expiry = NULL WHERE username = ?", (username,))
+            else:
+                self.connection.execute("INSERT OR REPLACE INTO tokens (username, token, expiry, registered) VALUES (?, ?, ?, 1)",
+                                        (username, token, expiry.isoformat()))
+
+    @synchronized
+    def setRegistered(self, username, registered):
+        with self.connection:
+            if registered:
+                self.connection.execute("INSERT OR IGNORE INTO tokens (username) VALUES (?)", (username,))
+                self.connection.execute("UPDATE tokens SET registered = 1 WHERE username = ?", (username,))
+            else:
+                self.connection.execute("DELETE FROM tokens WHERE username = ?", (username,))
+
+    @synchronized
+    def loadPersonRides(self, usernames, people):
+        """
+        Restore the PersonRides of the people with given usernames. People without persisted state get empty PersonRides.
+        Rides that refer to people that no longer exist are removed. Rides of generated days are generated again, without
+        the ones that are done and with the notification times they were rescheduled to. Days of people that changed
+        since (cfr. Person.fingerprint) can't be generated again: which of their rides are done is unknown, so they are
+        dropped rather than risk sending rides twice.
+        :param usernames: the people to restore
+        :param people: dict of usernames -> people, used to resolve all people rides refer to
+        :return: dict that maps usernames -> PersonRides
+        """
+        peopleRides = {username: PersonRides(people[username]) for username in usernames}
+        for username, lastGeneratedDay in self.connection.execute("SELECT username, lastGeneratedDay FROM people"):
+            if username in peopleRides and lastGeneratedDay is not None:
+                peopleRides[username].lastGeneratedDay = date.fromisoformat(lastGeneratedDay)
+
+        stale = list()
+        for stateId, username, data in self.connection.execute("SELECT id, username, data FROM rides"):
+            if username not in peopleRides:
+                continue
+            try:
+                ride = loadRide(data, people)
+            except MissingPerson as e:
+                logging.warning(f"Removing ride of {username}, it refers to unknown person {e}")
+                stale.append((stateId,))
+                continue
+            # rides persisted by older versions are kept as records from now on, their row is rewritten once they are updated
+            ride = compact(ride)
+            ride.stateId = stateId
+            peopleRides[username].addRide(ride)
+
+        if stale:
+            with self.connection:
+                self.connection.executemany("DELETE FROM rides WHERE id = ?", stale)
+
+        overrides = dict(self.connection.execute("SELECT uid, notificationTime FROM overrides"))
+        fingerprints = dict()
+        changed = list()
+        days = list()       # (PersonRides, day, generatedAt) to generate again
+        for username, day, generatedAt, fingerprint in self.connection.execute("SELECT username, day, generatedAt, fingerprint FROM days"):
+            if username not in peopleRides:
+                continue
+            personRides = peopleRides[username]
+            if username not in fingerprints:
+                fingerprints[username] = personRides.person.fingerprint
+            if fingerprint != fingerprints[username]:
+                changed.append((username, day))
+                continue
+            days.append((personRides, date.fromisoformat(day), datetime.fromisoformat(generatedAt)))
+
+        for (personRides, _, _), records in zip(days, batchGeneration.generateDays(days)):
+            for record in records:
+                if record.uid in overrides:
+                    if overrides[record.uid] is None:
+                        continue
+                    record.notificationTime = datetime.fromisoformat(overrides[record.uid])
+                personRides.addRide(record)
+
+        if changed:
+            logging.warning(f"Dropping the rides of {len(changed)} days of people that changed since they were generated")
+            with self.connection:
+                self.connection.executemany("DELETE FROM days WHERE username = ? AND day = ?", changed)
+                self.connection.executemany("DELETE FROM overrides WHERE username = ? AND day = ?", changed)
+        return peopleRides
+
+    @synchronized
+    def storeInFull(self, personRides):
+        """
+        Store the generated rides of a person in a row per ride from now on, because the person changed: the days generated
+        before can't be generated again (cfr. Person.fingerprint). Days generated since by the changed person stay as they are.
+        """
+        username = personRides.person.username
+        rides = [ride for ride in personRides.rides if isGenerated(ride)]
+        for ride in rides:
+            ride.generated = None
+        with self.connection:
+            self.connection.execute("DELETE FROM days WHERE username = ? AND fingerprint IS NOT ?", (username, personRides.person.fingerprint))
+            self.connection.execute("DELETE FROM overrides WHERE username = ? AND day NOT IN (SELECT day FROM days WHERE username = ?)",
+                                    (username, username))
+            self._insertRides(rides)
+
+    @synchronized
+    def usernames(self):
+        """ Usernames of all people with persisted state. """
+        return [username for username, in self.connection.execute(
+            "SELECT username FROM people UNION SELECT username FROM rides UNION SELECT username FROM days UNION SELECT username FROM tokens")]
+
+    @synchronized
+    def removePerson(self, username):
+        """ Remove all state of a person. """
+        with self.connection:
+            self.connection.execute("DELETE FROM rides WHERE username = ?", (username,))
+            self.connection.execute("DELETE FROM days WHERE username = ?", (username,))
+            self.connection.execute("DELETE FROM overrides WHERE username = ?", (username,))
+            self.connection.execute("DELETE FROM people WHERE username = ?", (username,))
+            self.connection.execute("DELETE FROM tokens WHERE username = ?", (username,))
+
+    @synchronized
+    def addGenerated(self, personRides, rides):
+        """ Persist newly generated rides of a person, together with the generation progress, in one transaction. """
+        with self.connection:
+            self._insertRides(rides, personRides.person.fingerprint)
+            self._updatePerson(personRides)
+
+    def _updatePerson(self, personRides):
+        lastGeneratedDay = personRides.lastGeneratedDay.isoformat() if personRides.lastGeneratedDay else None
+        self.connection.execute("INSERT OR REPLACE INTO people (username, lastGeneratedDay) VALUES (?, ?)",
+                                (personRides.person.username, lastGeneratedDay))
+
+    @synchronized
+    def addRide(self, ride):
+        with self.connection:
+            self._insertRides([ride])
+
+    def _insertRides(self, rides, fingerprint=None):
+        """ :param fingerprint: of the person that generated the rides, needed to store generated rides by their day """
+        for ride in rides:
+            if isGenerated(ride):
+                # the rides of the day are generated again on load
+                self.connection.execute("INSERT OR IGNORE INTO days (username, day, generatedAt, fingerprint) VALUES (?, ?, ?, ?)",
+                                        (ride.username, PersonRides.dayOf(ride.uid).isoformat(), ride.generatedAt.isoformat(), fingerprint))
+                continue
+            cursor = self.connection.execute("INSERT INTO rides (username, notificationTime, data) VALUES (?, ?, ?)",
+                                             (ride.username, ride.notificationTime.isoformat(), dumpRide(ride)))
+            ride.stateId = cursor.lastrowid
+
+    def _override(self, rides, notificationTimes):
+        self.connection.executemany("INSERT OR REPLACE INTO overrides (uid, username, day, notificationTime) VALUES (?, ?, ?, ?)", [
+            (ride.uid, ride.username, PersonRides.dayOf(ride.uid).isoformat(), notificationTime)
+            for ride, notificationTime in zip(rides, notificationTimes)
+        ])
+
+    @synchronized
+    def updateRide(self, ride):
+        """ Persist changes to a ride, e.g. a new notification time. """
+        with self.connection:
+            if isGenerated(ride):
+                self._override([ride], [ride.notificationTime.isoformat()])
+            else:
+                self.connection.execute("UPDATE rides SET notificationTime = ?, data = ? WHERE id = ?",
+                                        (ride.notificationTime.isoformat(), dumpRide(ride), ride.stateId))
+
+    def removeRide(self, ride):
+        self.removeRides([ride])
+
+    @synchronized
+    def removeRides(self, rides):
+        generated = [ride for ride in rides if isGenerated(ride)]
+        with self.connection:
+            self._override(generated, [None] * len(generated))
+            self.connection.executemany("DELETE FROM rides WHERE id = ?", [(ride.stateId,) for ride in rides if not isGenerated(ride)])
+
+    @synchronized
+    def removeDaysBefore(self, day):
+        """ Forget the days before day, together with what happened to their rides. """
+        with self.connection:
+            self.connection.execute("DELETE FROM days WHERE day < ?", (day.isoformat(),))
+            self.connection.execute("DELETE FROM overrides WHERE day < ?", (day.isoformat(),))
+
+    @synchronized
+    def migrateFrom(self, shelvePath):
+        """
+        Import the state of the shelve file used by older versions, if there is one and this store is still empty.
+        The shelve file is left untouched.
+        """
+        if self.get("migrated") or not dbm.whichdb(shelvePath):
+            return False
+
+        with shelve.open(shelvePath, flag="r") as old:
+            ridesMap = old.get("ridesMap", dict())
+            with self.connection:
+                for oldRides in ridesMap.values():
+                    # rides of older versions have no uid yet, adding them gives them one (cfr. PersonRides.addRide)
+                    personRides = PersonRides(oldRides.person)
+                    personRides.lastGeneratedDay = oldRides.lastGeneratedDay
+                    for ride in oldRides.rides:
+                        personRides.addRide(ride)
+                    self._insertRides([compact(ride) for ride in personRides.rides])
+                    self._updatePerson(personRides)
+                self.connection.executemany("INSERT OR REPLACE INTO userIds (userId, username) VALUES (?, ?)",
+                                            old.get("userIdMap", dict()).items())
+            self.set("lastGeneratedDay", old.get("lastGeneratedDay"))
+        self.set("migrated", True)
+
+        logging.info(f"Migrated state of {len(ridesMap)} people from {shelvePath} to {self.path}")
+        return True
@@ -0,0 +1,58 @@
+import time
+import threading
+from collections import Counter, deque
+from datetime import timedelta
+
+
+class SimulationStats(object):
+    """
+    Counts what happened to rides (notified, failed, discarded, ...) and how late rides were notified compared to their
+    notification time, i.e. the lag of the schedule. Thread safe, so notifying threads can record concurrently.
+    """
+    def __init__(self, window=10000):
+        """ :param window: amount of most recent lags to keep for percentiles """
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.lags = deque(maxlen=window)    # seconds
+        self.maxLag = 0.0
+        self.started = time.monotonic()
+
+    def count(self, event, amount=1):
+        with self.lock:
+            self.counts[event] += amount
+
+    def lag(self, lag: timedelta):
+        seconds = max(0.0, lag.total_seconds())
+        with self.lock:
+            self.lags.append(seconds)
+            self.maxLag = max(self.maxLag, seconds)
+
+    def percentile(self, p):
+        """ The p-th percentile (0-100) of the recent lags in seconds, 0 if there are none. """
+        with self.lock:
+            lags = sorted(self.lags)
+        if not lags:
+            return 0.0
+        return lags[min(len(lags) - 1, int(len(lags) * p / 100))]
+
+    def summary(self):
+        """ Dict with the counts, the notified rides per second (wall time) and the lag percentiles. """
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            counts = dict(self.counts)
+            maxLag = self.maxLag
+        return {
+            "elapsed": elapsed,
+            "counts": counts,
+            "ridesPerSecond": counts.get("notified", 0) / elapsed if elapsed > 0 else 0.0,
+            "lag50": self.percentile(50),
+            "lag95": self.percentile(95),
+            "lag99": self.percentile(99),
+            "lagMax": maxLag,
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        counts = ", ".join(f"{event}: {amount}" for event, amount in sorted(summary["counts"].items()))
+        return f"{counts or 'no rides'} in {summary['elapsed']:.1f}s ({summary['ridesPerSecond']:.1f} rides/s), " \
+               f"lag p50 {summary['lag50']:.1f}s, p95 {summary['lag95']:.1f}s, p99 {summary['lag99']:.1f}s, max {summary['lagMax']:.1f}s"
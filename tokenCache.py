@@ -0,0 +1,49 @@
+class TokenCache(object):
+    """
+    Login tokens of people with their expiry, and which people are known to be registered on the webservice.
+    Saves logging in before every request. Optionally persisted in a StateStore, so tokens survive a restart.
+    """
+    def __init__(self, lifetime, store=None):
+        """
+        :param lifetime: timedelta for how long a token is used before logging in again
+        :param store: optional StateStore to persist tokens in
+        """
+        self.lifetime = lifetime
+        self.store = store
+        self.tokens = dict()            # maps usernames -> (token, expiry)
+        self.registered = set()         # usernames of people known to be registered
+
+        if store is not None:
+            self.tokens, self.registered = store.loadTokens()
+
+    def get(self, username, now):
+        """ Returns the token of username if there is one that didn't expire at time now, None otherwise. """
+        token, expiry = self.tokens.get(username, (None, None))
+        if token is None or expiry <= now:
+            return None
+        return token
+
+    def set(self, username, token, now):
+        """ Store a fresh token. Having a token implies being registered. """
+        expiry = now + self.lifetime
+        self.tokens[username] = (token, expiry)
+        self.registered.add(username)
+        if self.store is not None:
+            self.store.setToken(username, token, expiry)
+
+    def invalidate(self, username):
+        """ Forget the token of username, e.g. after the webservice rejected it. """
+        if self.tokens.pop(username, None) is not None and self.store is not None:
+            self.store.setToken(username, None, None)
+
+    def isRegistered(self, username):
+        return username in self.registered
+
+    def setRegistered(self, username, registered=True):
+        if registered:
+            self.registered.add(username)
+        else:
+            self.registered.discard(username)
+            self.tokens.pop(username, None)
+        if self.store is not None:
+            self.store.setRegistered(username, registered)
@@ -0,0 +1,55 @@
+import logging
+
+
+class UserIdIndex(object):
+    """
+    Bidirectional mapping between userIds (assigned by the webservice) and usernames.
+    Both directions are dicts, so lookups are O(1). Every userId maps to one username and vice versa.
+    """
+    def __init__(self, userIds=None):
+        """ :param userIds: optional dict that maps userIds -> usernames, e.g. loaded from persistent state """
+        self.usernames = dict()         # maps userIds -> usernames
+        self.userIds = dict()           # maps usernames -> userIds
+        self.duplicates = 0             # amount of userIds that were handed out to more than one person
+        for userId, username in (userIds or dict()).items():
+            self.register(userId, username)
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def __contains__(self, userId):
+        return userId in self.usernames
+
+    def items(self):
+        """ Pairs of (userId, username). """
+        return self.usernames.items()
+
+    def getUsername(self, userId):
+        return self.usernames.get(userId)
+
+    def getUserId(self, username):
+        return self.userIds.get(username)
+
+    def register(self, userId, username):
+        """
+        Map userId to username. Existing mappings of either are replaced, so the index stays one to one.
+        A userId that already belonged to someone else is reported as duplicate (e.g. the webservice reused it after a reset).
+        Returns False if the userId was a duplicate, True otherwise.
+        """
+        unique = True
+        previousUsername = self.usernames.get(userId)
+        if previousUsername is not None and previousUsername != username:
+            self.duplicates += 1
+            logging.error(f"Duplicate user id {userId}: it belonged to {previousUsername} and is now given to {username}. "
+                          f"{previousUsername} no longer has a user id.")
+            del self.userIds[previousUsername]
+            unique = False
+
+        previousUserId = self.userIds.get(username)
+        if previousUserId is not None and previousUserId != userId:
+            logging.warning(f"User {username} got a new user id {userId}, was {previousUserId}")
+            del self.usernames[previousUserId]
+
+        self.usernames[userId] = username
+        self.userIds[username] = userId
+        return unique
@@ -1,7 +1,20 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 
 def daterange(start_date, end_date):
     """ iterator over [start_date, end_date[ """
     for n in range(int((end_date - start_date).days)):
         yield start_date + timedelta(n)
+
+
+EPOCH = datetime(1970, 1, 1)    # naive, like the times of the simulation
+
+
+def toEpoch(time):
+    """ Naive datetime -> whole seconds since EPOCH. """
+    return (time - EPOCH) // timedelta(seconds=1)
+
+
+def fromEpoch(seconds):
+    """ Seconds since EPOCH -> naive datetime. """
+    return EPOCH + timedelta(seconds=seconds)